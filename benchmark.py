@@ -0,0 +1,473 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+# The Twitter credentials are only read by the stub server of the benchmark, any value does
+for variable in ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_TOKEN',
+                 'TWITTER_ACCESS_TOKEN_SECRET'):
+    os.environ.setdefault(variable, 'benchmark')
+
+import grequests
+import pymysql.cursors
+
+import dbpool
+import iherb
+import page_store
+import requestiherb
+import sql
+import tweet_cache
+import twitter_api
+
+CATEGORY_PATH = "/c/benchmark"
+SEARCH_PATH = "/1.1/search/tweets.json"
+# The search endpoint of the brands with few tweets, LONG_TAIL_TWEETS each
+LONG_TAIL_SEARCH_PATH = "/1.1/long_tail/search/tweets.json"
+LONG_TAIL_TWEETS = 5
+TWEETS_PER_PAGE = 100
+FIRST_TWEET_ID = 10 ** 12
+SERVER_START_TIMEOUT = 10
+
+
+def _card(i):
+    return f'''<div class="product-cell-container col-xs-12 col-sm-12 col-md-8 col-lg-6">
+<div class="product ga-product col-sm-12" itemscope itemtype="http://schema.org/Product" id="pid_{1000 + i}">
+<div class="product-inner product-inner-wide">
+<div class="absolute-link-wrapper">
+<a class="absolute-link product-link" href="https://www.iherb.com/pr/benchmark-product-{i}/{1000 + i}"
+ data-product-id="{1000 + i}" data-part-number="BMK-{i:05d}" data-ga-brand-name="Brand {i % 97}"
+ data-ga-brand-id="{i % 97}" data-ga-discount-price="${10 + i % 90}.99"
+ data-ga-is-out-of-stock="{'True' if i % 11 == 0 else 'False'}" data-ga-is-discontinued="False"
+ data-ga-inventory-status="{'OutOfStock' if i % 11 == 0 else 'InStock'}" aria-label="Product {i}"></a>
+</div>
+<div class="product-image-wrapper"><span class="product-image">
+<img src="https://cloudinary.images-iherb.com/image/{i}.jpg" alt="Benchmark Product {i}" width="160" height="160"
+ loading="lazy"></span></div>
+<div class="product-title" itemprop="name"><bdi>Benchmark Product {i}, 500 mg, 120 Veggie Capsules</bdi></div>
+<div class="rating"><meta itemprop="ratingValue" content="{4.0 + i % 10 / 10:.1f}">
+<meta itemprop="reviewCount" content="{i * 7 % 5000}">
+<a class="stars scroll-to" href="#reviews" title="Rating"></a></div>
+<div class="product-price-top"><span class="price"><bdi>${12 + i % 90}.50</bdi></span>
+<meta itemprop="priceCurrency" content="USD"><meta itemprop="price" content="{12 + i % 90}.50"></div>
+<div class="product-badges"><span class="badge badge-special">Special!</span></div>
+<div itemprop="category" content="Benchmark"></div>
+<div class="product-cart"><button class="btn btn-add-to-cart" data-product-id="{1000 + i}">Add to Cart</button></div>
+</div></div></div>
+'''
+
+
+def generate_pages(nb_pages):
+    """
+    Returns synthetic result pages of the size and structure of the iHerb ones, the same on every call.
+    """
+    nb_results = nb_pages * requestiherb.RESULTS_PER_PAGE
+    header = f'<html><head><title>Benchmark</title></head><body><div class="sub-header">' \
+             f'<span class="sub-header-title display-items">{nb_results} results</span></div><div class="products">'
+    pages = []
+    for page in range(nb_pages):
+        start = page * requestiherb.RESULTS_PER_PAGE
+        cards = ''.join(_card(i) for i in range(start, start + requestiherb.RESULTS_PER_PAGE))
+        pages.append(header + cards + '</div></body></html>')
+    return pages
+
+
+def load_pages(arguments):
+    """
+    Returns the fixture pages: the latest pages of the page store if one is given, synthetic pages otherwise.
+    """
+    if arguments.page_store is None:
+        return generate_pages(arguments.pages)
+    store = page_store.PageStore(arguments.page_store)
+    urls = sorted(store.urls_with_prefix(""))[:arguments.pages]
+    pages = [content for _, content in store.iter_latest(urls)]
+    store.close()
+    return pages
+
+
+def _tweet(tweet_id, query, include_entities=True, extended=False):
+    tweet = {
+        "id": tweet_id, "id_str": str(tweet_id), "created_at": "Mon Jan 01 00:00:00 +0000 2024",
+        "full_text" if extended else "text": f"Trying the new {query} capsules, highly recommended! #health",
+        "entities": {"hashtags": [{"text": "health", "indices": [52, 59]}], "symbols": [], "user_mentions": [],
+                     "urls": []},
+        "user": {"id": tweet_id % 9973, "name": "Benchmark user", "screen_name": "benchmark",
+                 "description": "A user of the benchmark", "followers_count": 42},
+        "retweet_count": 0, "favorite_count": 1, "lang": "en",
+    }
+    if not include_entities:
+        del tweet["entities"]
+    return tweet
+
+
+def _search_results(parameters, tweets_per_name):
+    # An OR-query of quoted names finds the tweets of all of them, each tweet mentioning one of the names
+    query = parameters.get('q', '')
+    names = re.findall(r'"([^"]+)"', query) or [query]
+    max_id = int(parameters.get('max_id', FIRST_TWEET_ID))
+    since_id = max(int(parameters.get('since_id', 0)), FIRST_TWEET_ID - tweets_per_name * len(names))
+    ids = [tweet_id for tweet_id in range(max_id, max_id - TWEETS_PER_PAGE, -1) if tweet_id > since_id]
+    include_entities = parameters.get('include_entities', 'true') != 'false'
+    extended = parameters.get('tweet_mode') == 'extended'
+    response = {"statuses": [_tweet(tweet_id, names[tweet_id % len(names)], include_entities, extended)
+                             for tweet_id in ids],
+                "search_metadata": {"count": TWEETS_PER_PAGE}}
+    if len(ids) == TWEETS_PER_PAGE and ids[-1] - 1 > since_id:
+        # The client requests the tweets up to this max_id minus 1
+        response["search_metadata"]["next_results"] = f"?max_id={ids[-1]}&q=benchmark"
+    return response
+
+
+def _serve(port, pages, tweet_pages_per_query):
+    """
+    Serves the fixture pages and a stub of the Twitter search endpoint, until the process is killed.
+    """
+    from gevent.pywsgi import WSGIServer
+
+    bodies = [page.encode('utf-8') for page in pages]
+
+    def application(environ, start_response):
+        parameters = {key: values[0] for key, values in parse_qs(environ.get('QUERY_STRING', '')).items()}
+        if environ['PATH_INFO'] in (SEARCH_PATH, LONG_TAIL_SEARCH_PATH):
+            if environ['PATH_INFO'] == SEARCH_PATH:
+                response = _search_results(parameters, tweet_pages_per_query * TWEETS_PER_PAGE)
+            else:
+                response = _search_results(parameters, LONG_TAIL_TWEETS)
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(response).encode('utf-8')]
+        page = int(parameters.get('p', 1)) - 1
+        if environ['PATH_INFO'] != CATEGORY_PATH or not 0 <= page < len(bodies):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'']
+        start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+        return [bodies[page]]
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # The headers and the body are sent separately, which would stall on the delayed ACKs of the kept-alive
+    # connections without TCP_NODELAY, inherited by the accepted sockets
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(128)
+    WSGIServer(listener, application, log=None).serve_forever()
+
+
+@contextlib.contextmanager
+def stub_server(arguments):
+    """
+    Runs the stub HTTP server in another process, and yields its base URL.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--pages', str(arguments.pages),
+               '--tweet-pages', str(arguments.tweet_pages)]
+    if arguments.page_store is not None:
+        command += ['--page-store', arguments.page_store]
+    server = subprocess.Popen(command)
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.kill()
+        server.wait()
+
+
+class StubCursor(pymysql.cursors.DictCursor):
+    """
+    A cursor that renders the queries like pymysql does, but answers them in memory instead of sending them.
+
+    The id lookups return an id for each key, assigned on first sight, and the other queries return no rows. The
+    number of rows written by `executemany` is counted on the connection.
+    """
+
+    LOOKUP = re.compile(r"SELECT id, (\w+) AS `key` FROM (\w+)(?: WHERE \w+ IN \((.*)\))?;", re.S)
+    LITERAL = re.compile(r"'((?:[^'\\]|\\.)*)'|(-?\d+)")
+    UNESCAPE = re.compile(r"\\(.)")
+
+    def executemany(self, query, args):
+        self.connection.nb_rows += len(args)
+        return super().executemany(query, args)
+
+    def _query(self, query):
+        if not isinstance(query, str):
+            query = bytes(query).decode('utf-8')
+        self.connection.nb_queries += 1
+        self._rows = []
+        lookup = self.LOOKUP.match(query)
+        if lookup:
+            column, table, keys = lookup.groups()
+            ids = self.connection.ids.setdefault(table, {})
+            if keys is None:
+                self._rows = [{'id': id_, 'key': key} for key, id_ in ids.items()]
+            else:
+                for text, number in self.LITERAL.findall(keys):
+                    key = int(number) if number else self.UNESCAPE.sub(r"\1", text)
+                    self._rows.append({'id': ids.setdefault(key, len(ids) + 1), 'key': key})
+        self.rowcount = len(self._rows)
+        self.rownumber = 0
+        return self.rowcount
+
+    def _get_db(self):
+        return self.connection
+
+    def fetchall(self):
+        rows = self._rows[self.rownumber:]
+        self.rownumber = len(self._rows)
+        return rows
+
+    def fetchone(self):
+        if self.rownumber >= len(self._rows):
+            return None
+        self.rownumber += 1
+        return self._rows[self.rownumber - 1]
+
+
+class StubConnection:
+    """
+    An in-memory stand-in of a pymysql connection, to measure the DB layer without a MySQL server.
+    """
+
+    charset = 'utf8mb4'
+    encoding = 'utf8'
+
+    def __init__(self):
+        self.ids = {}
+        self.nb_rows = 0
+        self.nb_queries = 0
+
+    def cursor(self, cursor=None):
+        return StubCursor(self)
+
+    def literal(self, obj):
+        return pymysql.converters.escape_item(obj, self.charset)
+
+    def escape(self, obj, mapping=None):
+        return pymysql.converters.escape_item(obj, self.charset, mapping=mapping)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=True):
+        pass
+
+    def thread_id(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def silenced_stdout():
+    """
+    Sends the standard output of the process, and of the parsing processes it starts, to /dev/null.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def measure(stage):
+    """
+    Runs a stage twice, once timed and once under tracemalloc, and returns its duration, its peak memory in bytes
+    and the counts it returned.
+
+    Tracemalloc slows the allocations down, hence the separate runs. Only the memory of the main process is traced.
+    """
+    with silenced_stdout():
+        start = time.perf_counter()
+        counts = stage()
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return seconds, peak, counts
+
+
+def _result(seconds, peak, **counts):
+    result = {"seconds": round(seconds, 4), "peak_memory_bytes": peak}
+    for name, count in counts.items():
+        result[name] = count
+        result[f"{name}_per_sec"] = round(count / seconds, 2) if seconds else None
+    return result
+
+
+def bench_fetch(base_url, nb_pages):
+    urls = [f"{base_url}{CATEGORY_PATH}?p={page}" for page in range(1, nb_pages + 1)]
+    # The benchmark measures the fetching itself, without the politeness cap
+    requestiherb.RATE_LIMITER = requestiherb.HostRateLimiter(0)
+
+    def stage():
+        contents = [content for _, content in requestiherb.iter_html(urls, nb_pages, store=None)]
+        return {"pages": len(contents), "bytes": sum(len(content) for content in contents)}
+
+    seconds, peak, counts = measure(stage)
+    return _result(seconds, peak, **counts)
+
+
+def bench_parse(pages):
+    def stage():
+        return {"pages": len(pages), "products": sum(len(requestiherb.parse_products(page)) for page in pages)}
+
+    seconds, peak, counts = measure(stage)
+    return _result(seconds, peak, **counts)
+
+
+def bench_parse_parallel(pages, workers):
+    def stage():
+        parsed = requestiherb.parse_pages(((str(i), page) for i, page in enumerate(pages)), workers=workers)
+        return {"pages": len(pages), "products": sum(len(products) for _, products in parsed)}
+
+    seconds, peak, counts = measure(stage)
+    return _result(seconds, peak, **counts)
+
+
+def bench_db_write(pages, batch_size, use_mysql):
+    with silenced_stdout():
+        products = [prod for page in pages for prod in requestiherb.parse_products(page)]
+    batches = [products[start:start + batch_size] for start in range(0, len(products), batch_size)]
+    connection = StubConnection()
+    if not use_mysql:
+        sql.POOL = dbpool.ConnectionPool(lambda: connection, size=1, timeout=1, health_check_interval=float('inf'))
+
+    def stage():
+        sql.clear_id_caches()
+        nb_rows = connection.nb_rows
+        snapshot_at = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        for batch in batches:
+            iherb.persist_products(batch, snapshot_at=snapshot_at if iherb.SNAPSHOTS_ENABLED else None)
+        return {"products": len(products), "rows": connection.nb_rows - nb_rows}
+
+    seconds, peak, counts = measure(stage)
+    if use_mysql:
+        # The rows written to a real server are not counted
+        counts.pop("rows")
+    return _result(seconds, peak, **counts)
+
+
+def bench_twitter(base_url, nb_queries, concurrency, new_tweets=None):
+    twitter_api.API_URL = base_url + SEARCH_PATH
+    queries = [f"Brand {i}" for i in range(nb_queries)]
+    rate_limiter = twitter_api.RateLimiter(limit=10 ** 9, window=twitter_api.RATE_LIMIT_WINDOW)
+    no_cache = tweet_cache.TweetCountCache(':memory:', ttl=0, max_entries=1)
+    # The watermark of a previous run which counted all the tweets but the `new_tweets` newest ones
+    since_id = FIRST_TWEET_ID - new_tweets if new_tweets is not None else None
+
+    def stage():
+        pool = grequests.Pool(concurrency)
+        counts = list(pool.imap_unordered(
+            lambda query: twitter_api.update_number_of_tweets(query, 0, since_id, rate_limiter=rate_limiter,
+                                                              cache=no_cache)[0],
+            queries))
+        return {"queries": len(queries), "tweets": sum(counts)}
+
+    seconds, peak, counts = measure(stage)
+    return _result(seconds, peak, **counts)
+
+
+def bench_twitter_long_tail(base_url, nb_queries, concurrency, batching):
+    twitter_api.API_URL = base_url + LONG_TAIL_SEARCH_PATH
+    queries = [f"Tail Brand {i}" for i in range(nb_queries)]
+    no_cache = tweet_cache.TweetCountCache(':memory:', ttl=0, max_entries=1)
+
+    def stage():
+        rate_limiter = twitter_api.RateLimiter(limit=10 ** 9, window=twitter_api.RATE_LIMIT_WINDOW)
+        counts = list(twitter_api.iter_number_of_tweets(queries, concurrency, batching=batching,
+                                                        rate_limiter=rate_limiter, cache=no_cache))
+        return {"queries": len(queries), "tweets": sum(count for _, count, _ in counts),
+                "requests": rate_limiter.limit - rate_limiter.remaining}
+
+    seconds, peak, counts = measure(stage)
+    return _result(seconds, peak, **counts)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the fetch, parse, DB write and Twitter stages offline')
+    parser.add_argument('--pages', type=int, default=50, help="number of result pages (default 50)")
+    parser.add_argument('--page-store', metavar='DIR',
+                        help="take the pages from a page store instead of generating them")
+    parser.add_argument('--queries', type=int, default=20, help="number of Twitter searches (default 20)")
+    parser.add_argument('--tweet-pages', type=int, default=3, help="pages of results of each search (default 3)")
+    parser.add_argument('--mysql', action='store_true',
+                        help="write to the MySQL database of conf.json instead of the in-memory stand-in")
+    parser.add_argument('-o', '--output', metavar='FILE', help="also write the JSON report to this file")
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    arguments = get_arguments()
+    pages = load_pages(arguments)
+    if arguments.serve is not None:
+        _serve(arguments.serve, pages, arguments.tweet_pages)
+        return
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "parser_type": requestiherb.PARSER_TYPE,
+        "parse_workers": requestiherb.PARSE_WORKERS,
+        "fixture_pages": len(pages),
+        "stages": {},
+    }
+    with stub_server(arguments) as base_url:
+        report["stages"]["fetch"] = bench_fetch(base_url, len(pages))
+        report["stages"]["parse"] = bench_parse(pages)
+        report["stages"]["parse_parallel"] = bench_parse_parallel(pages, requestiherb.PARSE_WORKERS)
+        report["stages"]["db_write"] = bench_db_write(pages, iherb.DB_BATCH_SIZE, arguments.mysql)
+        report["stages"]["twitter"] = bench_twitter(base_url, arguments.queries, twitter_api.CONCURRENCY)
+        report["stages"]["twitter_incremental"] = bench_twitter(base_url, arguments.queries, twitter_api.CONCURRENCY,
+                                                                new_tweets=TWEETS_PER_PAGE // 2)
+        for name, batching in (("twitter_long_tail", False), ("twitter_long_tail_batched", True)):
+            report["stages"][name] = bench_twitter_long_tail(base_url, arguments.queries, twitter_api.CONCURRENCY,
+                                                             batching)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import sqlite3
+
+CREATE_TABLES = (
+    "CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT NOT NULL);",
+    "CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, state TEXT NOT NULL);",
+    "CREATE TABLE IF NOT EXISTS brands (name TEXT PRIMARY KEY, number_of_tweets INTEGER, since_id INTEGER);",
+)
+DELETE_ALL = ("DELETE FROM run;", "DELETE FROM pages;", "DELETE FROM brands;")
+INSERT_RUN_VALUE = "INSERT INTO run (key, value) VALUES (?, ?);"
+SELECT_RUN_VALUES = "SELECT key, value FROM run;"
+UPSERT_PAGE_STATE = "INSERT INTO pages (url, state) VALUES (?, ?) " \
+                    "ON CONFLICT (url) DO UPDATE SET state = excluded.state;"
+SELECT_PAGES_IN_STATE = "SELECT url FROM pages WHERE state = ?;"
+INSERT_BRAND = "INSERT OR IGNORE INTO brands (name) VALUES (?);"
+UPSERT_BRAND_COUNT = "INSERT INTO brands (name, number_of_tweets, since_id) VALUES (?, ?, ?) " \
+                     "ON CONFLICT (name) DO UPDATE SET number_of_tweets = excluded.number_of_tweets, " \
+                     "since_id = excluded.since_id;"
+SELECT_BRANDS = "SELECT name, number_of_tweets FROM brands;"
+SELECT_COUNTED_BRANDS = "SELECT name, number_of_tweets, since_id FROM brands WHERE number_of_tweets IS NOT NULL;"
+
+FETCHED = "fetched"
+PARSED = "parsed"
+PERSISTED = "persisted"
+
+
+class CheckpointStore:
+    """
+    The progress of the current run, stored in a SQLite file so that an interrupted run can be resumed.
+
+    The store records the URLs of the pages to scrape and the options of the run, the state reached by each page
+    (fetched, parsed, then persisted once its products are committed), the brands of the persisted products and the
+    number of tweets of each brand already counted, with its tweet watermark. Every change is committed at once, so
+    the store reflects the progress up to the moment the process stopped.
+
+    Attributes
+    ----------
+    path : str
+        The path of the SQLite file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    def start_run(self, url_list, **options):
+        """
+        Forgets the previous run and records the pages and options of a new one.
+        """
+        connection = self._get_connection()
+        with connection:
+            for query in DELETE_ALL:
+                connection.execute(query)
+            connection.execute(INSERT_RUN_VALUE, ("url_list", json.dumps(url_list)))
+            connection.execute(INSERT_RUN_VALUE, ("options", json.dumps(options)))
+
+    def load_run(self):
+        """
+        Returns the page URLs and the options of the recorded run, or None if there is no run to resume.
+        """
+        values = dict(self._get_connection().execute(SELECT_RUN_VALUES).fetchall())
+        if "url_list" not in values:
+            return None
+        return json.loads(values["url_list"]), json.loads(values["options"])
+
+    def finish_run(self):
+        """
+        Forgets the run once it has been completed.
+        """
+        connection = self._get_connection()
+        with connection:
+            for query in DELETE_ALL:
+                connection.execute(query)
+
+    def set_pages_state(self, urls, state):
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(UPSERT_PAGE_STATE, [(url, state) for url in urls])
+
+    def pages_in_state(self, state):
+        return {row[0] for row in self._get_connection().execute(SELECT_PAGES_IN_STATE, (state,))}
+
+    def track(self, pages, state):
+        """
+        Passes a stream of (url, content) pages through, recording that each of them reached the given state.
+        """
+        for url, content in pages:
+            self.set_pages_state([url], state)
+            yield url, content
+
+    def add_brands(self, brand_names):
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(INSERT_BRAND, [(name,) for name in brand_names])
+
+    def set_number_of_tweets(self, brand_name, number_of_tweets, since_id=None):
+        connection = self._get_connection()
+        with connection:
+            connection.execute(UPSERT_BRAND_COUNT, (brand_name, number_of_tweets, since_id))
+
+    def brands(self):
+        """
+        Returns the recorded brands, mapped to their number of tweets or to None if it has not been counted yet.
+        """
+        return dict(self._get_connection().execute(SELECT_BRANDS).fetchall())
+
+    def counted_brands(self):
+        """
+        Returns the brands whose tweets have been counted, mapped to their number of tweets and the ID of the newest.
+        """
+        return {name: (number_of_tweets, since_id)
+                for name, number_of_tweets, since_id in self._get_connection().execute(SELECT_COUNTED_BRANDS)}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            with self._connection:
+                for query in CREATE_TABLES:
+                    self._connection.execute(query)
+        return self._connection
@@ -0,0 +1,165 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection of the pool became free within the timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    A pool of MySQL connections shared by every query of a run.
+
+    Connections are opened lazily, up to `size` of them, and handed back to the pool after use instead of being closed.
+    A connection that stayed idle longer than `health_check_interval` seconds is pinged before being reused, which
+    transparently reconnects it if the server dropped it. A connection released as broken is closed and replaced by a
+    new one on demand.
+
+    Attributes
+    ----------
+    size : int
+        The maximum number of open connections.
+    timeout : float
+        The maximum number of seconds to wait for a free connection.
+    health_check_interval : float
+        The idle time, in seconds, after which a connection is checked before being reused.
+    """
+
+    def __init__(self, connect, size, timeout, health_check_interval):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._nb_acquired = 0
+        self._nb_waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._nb_reconnects = 0
+
+    def acquire(self):
+        """
+        Takes a healthy connection from the pool, opening a new one if the pool is not full.
+
+        Returns
+        -------
+        pymysql.connections.Connection
+            A connection reserved for the caller until it is released.
+
+        Raises
+        ------
+        PoolTimeoutError
+            If every connection stayed busy for `timeout` seconds.
+        pymysql.err.Error
+            If a new connection could not be opened, or an idle one could not be reconnected.
+        """
+        start = time.monotonic()
+        try:
+            connection, idle_since = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._open_if_not_full()
+            idle_since = time.monotonic()
+            if connection is None:
+                self._nb_waits += 1
+                try:
+                    connection, idle_since = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeoutError(f"No connection available after {self.timeout} seconds")
+        wait = time.monotonic() - start
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._nb_acquired += 1
+
+        if time.monotonic() - idle_since > self.health_check_interval:
+            try:
+                self._check(connection)
+            except pymysql.err.Error:
+                # The connection could not be reconnected: it is given back as broken, so that its slot is freed
+                self.release(connection, broken=True)
+                raise
+        return connection
+
+    def release(self, connection, broken=False):
+        """
+        Hands a connection back to the pool, or closes it when it is broken.
+        """
+        if broken:
+            try:
+                connection.close()
+            except pymysql.err.Error:
+                pass
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put((connection, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager reserving a connection of the pool for the duration of the block.
+
+        The connection is released as broken if the block raises a connection error.
+        """
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken=broken)
+
+    def stats(self):
+        """
+        Returns the metrics of the pool: number of acquisitions, of waits for a busy pool, the total and maximum wait
+        time in seconds, the number of reconnections and the number of open connections.
+        """
+        return {
+            "acquired": self._nb_acquired,
+            "waits": self._nb_waits,
+            "total_wait": round(self._total_wait, 6),
+            "max_wait": round(self._max_wait, 6),
+            "reconnects": self._nb_reconnects,
+            "open_connections": self._opened,
+        }
+
+    def close(self):
+        """
+        Closes every idle connection of the pool.
+        """
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.release(connection, broken=True)
+
+    def _open_if_not_full(self):
+        with self._lock:
+            if self._opened >= self.size:
+                return None
+            self._opened += 1
+        try:
+            return self._connect()
+        except pymysql.err.Error:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def _check(self, connection):
+        thread_id = connection.thread_id()
+        # ping() reconnects the connection if the server closed it, which gives it a new server thread id
+        connection.ping(reconnect=True)
+        if connection.thread_id() != thread_id:
+            self._nb_reconnects += 1
+            logging.info("Reconnected a dropped MySQL connection of the pool")
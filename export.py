@@ -0,0 +1,163 @@
+import os
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+# pyarrow is only imported when an export starts, as it is optional and slow to import
+pa = None
+pq = None
+
+PRODUCTS_DATASET = "products"
+BRAND_TWEETS_DATASET = "brand_tweets"
+
+
+def _import_pyarrow():
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The Parquet export requires the pyarrow package")
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def _products_schema():
+    # The category is not a column of the files: it is the name of their partition directory
+    return pa.schema([
+        ("product_id", pa.int64()),
+        ("name", pa.string()),
+        ("url", pa.string()),
+        ("part_no", pa.string()),
+        ("brand_id", pa.string()),
+        ("brand_name", pa.string()),
+        ("rating", pa.float64()),
+        ("nb_reviews", pa.int64()),
+        ("price", pa.float64()),
+        ("discount_price", pa.float64()),
+        ("currency", pa.string()),
+        ("out_of_stock", pa.bool_()),
+        ("has_discount", pa.bool_()),
+        ("inventory_status", pa.string()),
+        ("fingerprint", pa.string()),
+        ("scraped_at", pa.timestamp("s", tz="UTC")),
+    ])
+
+
+def _brand_tweets_schema():
+    return pa.schema([
+        ("brand_name", pa.string()),
+        ("number_of_tweets", pa.int64()),
+        ("counted_at", pa.timestamp("s", tz="UTC")),
+    ])
+
+
+class ParquetExporter:
+    """
+    Writes the products and the brand tweet counts of a run as Parquet files, for the analytics side.
+
+    The files are partitioned the Hive way, by category and date for the products, and by date for the tweet counts:
+
+        <root>/products/category=<category>/date=<YYYY-MM-DD>/part-<run>.parquet
+        <root>/brand_tweets/date=<YYYY-MM-DD>/part-<run>.parquet
+
+    The rows are buffered and written as a new row group of the file of their partition every `batch_size` rows, so
+    the memory used does not grow with the size of the run. A file is written under a hidden temporary name, which
+    the Parquet readers skip, and only takes its final name when the exporter is closed.
+
+    Attributes
+    ----------
+    root : str
+        The directory of the datasets.
+    batch_size : int
+        The number of rows of a partition written at once.
+    compression : str
+        The Parquet compression codec.
+    date : str
+        The date partition of the run.
+    run_id : str
+        The name of the files written by the run, unique to the run.
+    """
+
+    def __init__(self, root, batch_size, compression):
+        _import_pyarrow()
+        self.root = root
+        self.batch_size = batch_size
+        self.compression = compression
+        now = datetime.now(timezone.utc)
+        self.date = now.strftime("%Y-%m-%d")
+        self.run_id = f"{now.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._buffers = {}
+        self._writers = {}
+
+    def write_products(self, products):
+        """
+        Adds a batch of products to the export of their category.
+        """
+        scraped_at = int(time.time())
+        for prod in products:
+            rows = self._buffers.setdefault((PRODUCTS_DATASET, prod.category), [])
+            rows.append({
+                "product_id": prod.product_id,
+                "name": prod.name,
+                "url": prod.url,
+                "part_no": prod.part_no,
+                "brand_id": str(prod.brand_id),
+                "brand_name": prod.brand_name,
+                "rating": prod.rating,
+                "nb_reviews": prod.nb_reviews,
+                "price": prod.price,
+                "discount_price": prod.discount_price,
+                "currency": prod.currency,
+                "out_of_stock": prod.out_of_stock,
+                "has_discount": prod.has_discount,
+                "inventory_status": prod.inventory_status,
+                "fingerprint": prod.fingerprint(),
+                "scraped_at": scraped_at,
+            })
+            if len(rows) >= self.batch_size:
+                self._flush((PRODUCTS_DATASET, prod.category))
+
+    def write_number_of_tweets(self, brand_name, number_of_tweets):
+        """
+        Adds the number of tweets of a brand to the export of the tweet counts.
+        """
+        rows = self._buffers.setdefault((BRAND_TWEETS_DATASET, None), [])
+        rows.append({"brand_name": brand_name, "number_of_tweets": number_of_tweets, "counted_at": int(time.time())})
+        if len(rows) >= self.batch_size:
+            self._flush((BRAND_TWEETS_DATASET, None))
+
+    def close(self):
+        """
+        Writes the buffered rows and gives the files their final name.
+        """
+        for partition in list(self._buffers):
+            self._flush(partition)
+        for path, writer in self._writers.values():
+            writer.close()
+            directory, filename = os.path.split(path)
+            os.replace(path, os.path.join(directory, filename[1:-len(".tmp")]))
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush(self, partition):
+        rows = self._buffers.pop(partition, None)
+        if not rows:
+            return
+        dataset, category = partition
+        schema = _products_schema() if dataset == PRODUCTS_DATASET else _brand_tweets_schema()
+        if partition not in self._writers:
+            directory = os.path.join(self.root, dataset)
+            if category is not None:
+                directory = os.path.join(directory, f"category={quote(str(category), safe='')}")
+            directory = os.path.join(directory, f"date={self.date}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f".part-{self.run_id}.parquet.tmp")
+            self._writers[partition] = (path, pq.ParquetWriter(path, schema, compression=self.compression))
+        table = pa.Table.from_pylist(rows, schema=schema)
+        self._writers[partition][1].write_table(table)
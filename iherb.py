@@ -1,28 +1,30 @@
 import argparse
 import json
 import logging
-import time
-from fake_useragent import UserAgent
+from datetime import datetime, timezone
+from itertools import zip_longest
 
-import requestiherb
-import sql
-import twitter_api
+from settings import config
 
-# Import all the Global variables from the configuration file
-with open('conf.json', 'r') as f:
-    config = json.load(f)
-
-BROWSERS = config['BROWSERS']
 LOG_FILENAME = config['LOG_FILENAME']
 LOGGING_LEVEL = config['LOGGING_LEVEL']
 LOG_FORMAT = config['LOG_FORMAT']
 CATEGORIES = config['CATEGORIES']
 DEFAULT_LIMIT = config['DEFAULT_LIMIT']
-TIME_SLEEP = config['TIME_SLEEP']
 URL = config['URL']
+DB_BATCH_SIZE = config['DB_BATCH_SIZE']
+PAGE_VALIDATORS_PATH = config['INCREMENTAL']['PAGE_VALIDATORS_PATH']
+CHECKPOINT_PATH = config['CHECKPOINT_PATH']
+PAGE_STORE_PATH = config['PAGE_STORE']['PATH']
+SNAPSHOTS_ENABLED = config['PRODUCT_SNAPSHOTS']['ENABLED']
+SNAPSHOTS_ONLY_ON_CHANGE = config['PRODUCT_SNAPSHOTS']['ONLY_ON_CHANGE']
+EXPORT_ENABLED = config['EXPORT']['ENABLED']
+EXPORT_PATH = config['EXPORT']['PATH']
+EXPORT_BATCH_SIZE = config['EXPORT']['BATCH_SIZE']
+EXPORT_COMPRESSION = config['EXPORT']['COMPRESSION']
+WATERMARKS_ENABLED = config['TWEET_WATERMARKS']['ENABLED']
+REFETCH_ROUNDS = config['PAGE_DRIFT']['REFETCH_ROUNDS']
 
-
-UA = UserAgent(browsers=BROWSERS)
 logging.basicConfig(filename=LOG_FILENAME, level=logging.getLevelName(LOGGING_LEVEL),
                     format=LOG_FORMAT)
 
@@ -45,9 +47,12 @@ def get_parameters_for_scrapping():
     Description:
         This function uses argparse to retrieve the command-line parameters required for running a web scraping script.
         The required parameters are:
-        - The category for which to retrieve the scraping results, which must be chosen from a predefined list of
-        categories.
+        - The categories for which to retrieve the scraping results, which must be chosen from a predefined list of
+        categories, or the 'all' flag to retrieve every category of the list, or the 'resume' flag to complete the
+        last run, which was interrupted.
         - (Optional) The maximum number of results to retrieve, which must be a positive integer.
+        - (Optional) The incremental flag, to only write the products that changed since the last run.
+        - (Optional) The replay flag, to parse the pages stored by the previous runs again instead of fetching them.
 
         If the user does not specify the limit parameter, the default limit will be used.
 
@@ -58,10 +63,20 @@ def get_parameters_for_scrapping():
         This function does not raise any exception.
     """
     parser = argparse.ArgumentParser(description='Take a query')
-    parser.add_argument('-c', '--category', type=str, metavar='', required=True, choices=CATEGORIES,
-                        help=f'Choose category from the following list:\n\n{CATEGORIES}')
+    categories = parser.add_mutually_exclusive_group(required=True)
+    categories.add_argument('-c', '--category', type=str, metavar='', nargs='+', choices=CATEGORIES,
+                            help=f'Choose one or several categories from the following list:\n\n{CATEGORIES}')
+    categories.add_argument('-a', '--all', action='store_true', help="scrape all the categories")
+    categories.add_argument('-r', '--resume', action='store_true',
+                            help="resume the last run where it stopped, with the same categories and options")
     parser.add_argument('-l', '--limit', type=int, metavar='', help="(optional) number of results")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="(optional) skip the pages and products that did not change since the last run")
+    parser.add_argument('--replay', action='store_true',
+                        help="(optional) parse the pages of the page store again, without requesting the website")
     arguments = parser.parse_args()
+    if arguments.replay and arguments.resume:
+        parser.error("--replay cannot be combined with --resume")
     if arguments.limit is None:
         lim = DEFAULT_LIMIT
     else:
@@ -69,95 +84,365 @@ def get_parameters_for_scrapping():
     return arguments, lim
 
 
-def pause_program(pause_time=TIME_SLEEP):
+if __name__ == '__main__':
+    # The arguments are parsed before the modules below are imported, so that '--help' and the wrong arguments are
+    # answered at once
+    args, limit = get_parameters_for_scrapping()
+
+# grequests monkey-patches the standard library with gevent, which has to happen before requests and ssl are imported
+import grequests  # noqa: F401,E402
+import checkpoint as checkpoint_store  # noqa: E402
+import export  # noqa: E402
+import metrics  # noqa: E402
+import page_store  # noqa: E402
+import page_validators  # noqa: E402
+import product_index  # noqa: E402
+import requestiherb  # noqa: E402
+import sql  # noqa: E402
+import twitter_api  # noqa: E402
+
+
+def persist_products(products, links=(), incremental=False, snapshot_at=None):
     """
-    Pauses the program for a specified duration.
+    Writes a batch of products into the database.
 
-    This function is useful for waiting before sending more requests to an API,
-    such as the Twitter API, to avoid hitting rate limits. It prints a message
-    before and after the pause.
+    The categories, brands and inventory statuses of the batch are inserted first so that the products can refer to
+    them, and the whole batch is committed as a single transaction on one pooled connection.
 
     Args:
-        pause_time (int, optional): The duration of the pause in seconds. Default value is TIME_SLEEP.
+        products (list): A list of Product objects to insert or update.
+        links (list, optional): The (iHerb product id, category) of the products already written during the run
+            that have been found in another category.
+        incremental (bool, optional): If True, only the products whose fingerprint changed are written.
+        snapshot_at (datetime, optional): If given, the values of the products are also appended to their price
+            history at that time: the values of every product, or only of those whose fingerprint changed when
+            PRODUCT_SNAPSHOTS.ONLY_ON_CHANGE is set.
 
     Returns:
-        None
+        bool: True if the products have been written, False if their batch has been rolled back.
+    """
+    with metrics.timer("db_batch_seconds"), sql.unit_of_work():
+        changed_ids = None
+        # The fingerprints have to be compared before the upsert overwrites them
+        if incremental or (snapshot_at is not None and SNAPSHOTS_ONLY_ON_CHANGE):
+            changed = sql.filter_changed_products(products)
+            changed_ids = {prod.product_id for prod in changed}
+            if incremental:
+                products = changed
+        sql.insert_categories_into_db(products)
+        sql.insert_brands_into_db(products)
+        sql.insert_inventory_status_into_db(products)
+        written = sql.insert_product_into_db(products, snapshot_at=snapshot_at,
+                                             snapshot_ids=changed_ids if SNAPSHOTS_ONLY_ON_CHANGE else None)
+        sql.insert_product_categories(links)
+    if written:
+        print(f"Saved a batch of {len(products)} products into the DB")
+    return written
+
+
+def _flush_batch(batch, links, batch_urls, incremental, snapshot_at, validators, checkpoint, exporter):
+    """
+    Persists a batch of products, then records that the pages they come from have been persisted. The pages of a
+    batch rolled back are left in their previous state, and their validators are not stored, so that a resumed or
+    incremental run scrapes them again.
     """
-    print(f"We reached the maximum number of requests.")
-    print(f"Pausing for {TIME_SLEEP} seconds before to continue the requests on Twitter API...")
-    time.sleep(pause_time)
-    print("Done pausing!")
+    written = persist_products(batch, links, incremental, snapshot_at)
+    if written and exporter is not None:
+        exporter.write_products(batch)
+    if written and validators is not None:
+        validators.commit(batch_urls)
+    if written and checkpoint is not None:
+        checkpoint.add_brands({p.brand_name for p in batch})
+        checkpoint.set_pages_state(batch_urls, checkpoint_store.PERSISTED)
 
 
-def run_requests_on_db_and_api():
+def _iter_fetched_pages(url_list, limit, checkpoint, validators, prefetched):
     """
-    This function inserts product data into the database and retrieves the number of tweets
-    related to each brand using the Twitter API.
+    Yields the URL and the content of each page, read back from the page store if the interrupted run being resumed
+    already fetched it, and requested otherwise.
+    """
+    url_list = url_list[:limit]
+    fetched = set()
+    if checkpoint is not None and requestiherb.PAGE_STORE is not None:
+        fetched = checkpoint.pages_in_state(checkpoint_store.FETCHED) | \
+                  checkpoint.pages_in_state(checkpoint_store.PARSED)
+    resumed = set()
+    if fetched:
+        stored_urls = [url for url in url_list if url in fetched]
+        for url, content in requestiherb.iter_stored_html(stored_urls, len(stored_urls), requestiherb.PAGE_STORE):
+            resumed.add(url)
+            yield url, content
+        print(f"Read {len(resumed)} pages fetched by the interrupted run back from the page store")
+        logging.info(f"Read {len(resumed)} pages fetched by the interrupted run back from the page store")
+    # The pages missing from the store are requested again
+    urls = [url for url in url_list if url not in resumed]
+    yield from requestiherb.iter_html(urls, len(urls), validators=validators, prefetched=prefetched)
+
+
+def _iter_parsed_pages(pages, index, refetch_rounds, checkpoint=None):
+    """
+    Yields the URL and the products of each page, then of the pages the index asks to fetch again once all of them
+    have been indexed, for up to `refetch_rounds` rounds. With a checkpoint store, the pages fetched again are
+    recorded as fetched, like the first ones.
+    """
+    yield from requestiherb.parse_pages(pages)
+    for _ in range(refetch_rounds):
+        urls = index.pages_to_refetch()
+        if not urls:
+            break
+        print(f"Fetching {len(urls)} pages again, as the listings shifted during the crawl")
+        logging.info(f"Fetching again the pages {urls}, as the listings shifted during the crawl")
+        metrics.increment("pages_refetched", len(urls))
+        refetched = requestiherb.iter_html(urls, len(urls))
+        if checkpoint is not None:
+            refetched = checkpoint.track(refetched, checkpoint_store.FETCHED)
+        yield from requestiherb.parse_pages(refetched)
+
+
+def _report_drift(index):
+    if index.nb_duplicates:
+        print(f"{index.nb_duplicates} products were found on two pages of the same listing")
+        logging.info(f"{index.nb_duplicates} products were found on two pages of the same listing")
+    for listing, missing in index.missing_counts().items():
+        metrics.increment("products_missing", missing)
+        print(f"{missing} products of {listing} could not be found")
+        logging.warning(f"{missing} products of {listing} could not be found, out of {index.expected_counts[listing]}")
+
+
+def scrape_products(url_list, limit, batch_size=DB_BATCH_SIZE, incremental=False, checkpoint=None, replay_store=None,
+                    prefetched=None, exporter=None, expected_counts=None):
+    """
+    Fetches, parses and persists the products of the given result pages as a stream.
 
-    It performs the following operations:
-        1. Sets the database to use.
-        2. Inserts categories, brands, inventory statuses, and products into the database.
-        3. Retrieves brand names from the database.
-        4. Fetches the number of tweets associated with each brand name using the Twitter API.
-        5. Updates the number of tweets in the database for each brand.
-        6. Commits the changes to the database.
-
-    Note: The function assumes that the 'connection', 'sql', and 'twitter_api' objects
-    have been properly initialized outside the function.
-    """
-    sql.insert_categories_into_db(req.products)
-    sql.insert_brands_into_db(req.products)
-    sql.insert_inventory_status_into_db(req.products)
-    sql.insert_product_into_db(req.products)
-    brands = sql.get_brands_names(req.products)
-    for index, brand in enumerate(brands):
-        continue_requests = True
-        while continue_requests:
-            try:
-                brands[index]['number_of_tweets'] = twitter_api.get_number_of_tweets_async(query=brands[index]["name"])
-                print("Getting tweets request number ", index, " out of ", len(brands) - 1)
-                continue_requests = False
-            except ValueError as err:
-                logging.info(err)
-                pause_program(pause_time=TIME_SLEEP)
-        sql.update_number_tweets(brands)
-
-
-def create_product_list(page_list):
-    """
-    Create a list of products from the provided list of pages using the global 'req' object.
-
-    This function iterates through the pages and retrieves detailed product information
-    for each page using the 'req' object (an instance of the iHerbRequest class).
-    It also prints the progress of processing each page and the total number of products scraped.
+    Each page is parsed as soon as it has been downloaded, by a pool of PARSE_WORKERS processes, and its products are
+    written to the database in batches of `batch_size`, so only the pages in flight and the current batch are held in
+    memory.
 
-    Args:
-        page_list (list): A list of pages to extract product information from.
+    In incremental mode, the pages are requested conditionally on the ETag / Last-Modified validators of the last
+    run and the pages that did not change are skipped, and only the products whose fingerprint changed are written.
+    The validators of a page are saved once its products are in the database.
 
-    Note: The function assumes that the 'get_detailed_information_from_html' method is
-    available in the 'req' object (iHerbRequest instance) and updates the 'products' attribute of the object.
-    """
-    for i, page in enumerate(page_list):
-        print(f"process the page : {i}")
-        req.get_detailed_information_from_html(page)
-        print(f"success processing the page : {i}")
+    The pages may belong to several categories: a product found in several of them is only written once, and then
+    associated with each of its categories.
 
-    print(f"Total number of product scrapped = {len(req.products)}")
+    The listings shift while their pages are crawled, so a product found again on another page of the same listing
+    is only written once too. When a listing crawled in full gives fewer products than it announced, the pages
+    missing or affected by the drift are fetched again, for up to REFETCH_ROUNDS rounds.
 
+    With a checkpoint store, the state reached by each page and the brands of the persisted products are recorded
+    as the run goes, and the pages already persisted by an interrupted run are skipped.
 
-if __name__ == '__main__':
-    args, limit = get_parameters_for_scrapping()
+    With a replay store, the pages are read from the store as they were last fetched instead of being requested. The
+    price history is not written then, as the values of the pages are not those of the time of the run.
 
-    # Create an object of RequestIherb
-    req = requestiherb.RequestIherb(URL + args.category, limit)
-    print(f"This request contains {min(limit, len(req.url_list))} pages of products")
+    Args:
+        url_list (list): The URLs of the result pages.
+        limit (int): The maximum number of pages to scrape.
+        batch_size (int, optional): The number of products written to the database at once. Default value is
+            DB_BATCH_SIZE.
+        incremental (bool, optional): If True, run in incremental mode.
+        checkpoint (checkpoint.CheckpointStore, optional): The store recording the progress of the run.
+        replay_store (page_store.PageStore, optional): The store to read the pages from.
+        prefetched (dict, optional): The responses of the pages already fetched, by URL, which are not requested
+            again.
+        exporter (export.ParquetExporter, optional): The exporter the persisted products are also written to.
+        expected_counts (dict, optional): The number of results announced by each listing crawled in full, by
+            listing URL, which the products found are checked against.
 
-    # Get the html of all the pages obtained with the request
-    all_pages = requestiherb.get_html(req.url_list, limit)
+    Returns:
+        set: The names of the brands of all the scraped products.
+    """
+    # Stored pages are not requested, so there is nothing to make conditional when replaying
+    validators = None
+    if incremental and replay_store is None:
+        validators = page_validators.PageValidatorStore(PAGE_VALIDATORS_PATH)
+    snapshot_at = None
+    if SNAPSHOTS_ENABLED and replay_store is None:
+        # All the snapshot rows of a run share its start time, to the second
+        snapshot_at = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    brand_names = set()
+    if checkpoint is not None:
+        persisted = checkpoint.pages_in_state(checkpoint_store.PERSISTED)
+        url_list = [url for url in url_list[:limit] if url not in persisted]
+        limit = len(url_list)
+        brand_names.update(checkpoint.brands())
+    index = product_index.ProductIndex(expected_counts, requestiherb.RESULTS_PER_PAGE)
+    batch = []
+    links = []
+    batch_urls = []
+    nb_products = 0
+    if replay_store is not None:
+        pages = requestiherb.iter_stored_html(url_list, limit, replay_store)
+    else:
+        pages = _iter_fetched_pages(url_list, limit, checkpoint, validators, prefetched)
+    if checkpoint is not None:
+        pages = checkpoint.track(pages, checkpoint_store.FETCHED)
+    # Stored pages cannot be fetched again
+    refetch_rounds = REFETCH_ROUNDS if replay_store is None else 0
+    for i, (url, products) in enumerate(_iter_parsed_pages(pages, index, refetch_rounds, checkpoint)):
+        print(f"success processing the page : {i}")
+        if checkpoint is not None:
+            checkpoint.set_pages_state([url], checkpoint_store.PARSED)
+        brand_names.update(p.brand_name for p in products)
+        new_products, new_links = index.add(url, products)
+        batch.extend(new_products)
+        links.extend(new_links)
+        nb_products += len(new_products)
+        batch_urls.append(url)
+        if len(batch) + len(links) >= batch_size:
+            _flush_batch(batch, links, batch_urls, incremental, snapshot_at, validators, checkpoint, exporter)
+            batch = []
+            links = []
+            batch_urls = []
+    if batch_urls:
+        _flush_batch(batch, links, batch_urls, incremental, snapshot_at, validators, checkpoint, exporter)
+
+    _report_drift(index)
+    print(f"Total number of product scrapped = {nb_products}")
+    if validators is not None:
+        print(f"{validators.nb_not_modified} pages were not modified since the last run")
+        validators.close()
+    return brand_names
+
+
+def run_requests_on_api(brand_names, checkpoint=None, exporter=None):
+    """
+    This function retrieves the number of tweets related to each brand using the Twitter API.
 
-    # Create the list of products from HTML pages
-    create_product_list(all_pages)
+    It performs the following operations:
+        1. Retrieves the brands from the database.
+        2. Fetches the number of tweets associated with each brand name using the Twitter API, several brands at a
+           time within the rate limit of the API. When the watermarks are enabled, only the tweets newer than the
+           newest one counted by the previous run are fetched, and added to the number of tweets of the brand.
+        3. Buffers the number of tweets of the brands and their new watermark and writes them to the database in
+           batches.
 
-    # Run the requests to populate and update the DB
-    run_requests_on_db_and_api()
+    Args:
+        brand_names (set): The names of the brands to count the tweets of.
+        checkpoint (checkpoint.CheckpointStore, optional): The store recording the progress of the run. The number
+            of tweets of each brand is recorded in it, and the brands it already knows are not counted again.
+        exporter (export.ParquetExporter, optional): The exporter the number of tweets of the brands is also
+            written to.
+    """
+    if not brand_names:
+        return
+    brands = {brand["name"]: brand for brand in sql.get_brands_names(brand_names)}
+    counted = checkpoint.counted_brands() if checkpoint is not None else {}
+    with sql.BrandTweetsBuffer() as buffer:
+        for name, brand in brands.items():
+            if name in counted:
+                number_of_tweets, since_id = counted[name]
+                buffer.add(brand['id'], number_of_tweets, since_id)
+                if exporter is not None:
+                    exporter.write_number_of_tweets(name, number_of_tweets)
+        to_count = [name for name in brands if name not in counted]
+        watermarks = None
+        if WATERMARKS_ENABLED:
+            watermarks = {name: (brands[name]['number_of_tweets'], brands[name]['tweets_since_id'])
+                          for name in to_count}
+        tweet_counts = twitter_api.iter_number_of_tweets(to_count, watermarks=watermarks)
+        for index, (name, number_of_tweets, since_id) in enumerate(tweet_counts):
+            print("Getting tweets request number ", index, " out of ", len(to_count) - 1)
+            if number_of_tweets is not None:
+                buffer.add(brands[name]['id'], number_of_tweets, since_id)
+                if checkpoint is not None:
+                    checkpoint.set_number_of_tweets(name, number_of_tweets, since_id)
+                if exporter is not None:
+                    exporter.write_number_of_tweets(name, number_of_tweets)
+    logging.info(f"Tweet count cache: {twitter_api.CACHE.hits} hits, {twitter_api.CACHE.misses} misses")
+    logging.info(f"Twitter requests waited {twitter_api.RATE_LIMITER.total_sleep:.0f} seconds in total for the "
+                 f"rate limit")
+
+
+def report_metrics():
+    """
+    Logs and prints the metrics of the run, and writes them to the Prometheus text file if one is set.
+    """
+    if not metrics.ENABLED:
+        return
+    metrics.increment("tweet_cache_hits", twitter_api.CACHE.hits)
+    metrics.increment("tweet_cache_misses", twitter_api.CACHE.misses)
+    report = json.dumps(metrics.REGISTRY.report(), indent=2)
+    logging.info(f"Metrics of the run: {report}")
+    print(f"Metrics of the run: {report}")
+    if metrics.PROMETHEUS_PATH:
+        metrics.REGISTRY.write_prometheus(metrics.PROMETHEUS_PATH)
+
+
+if __name__ == '__main__':
+    exporter = export.ParquetExporter(EXPORT_PATH, EXPORT_BATCH_SIZE, EXPORT_COMPRESSION) if EXPORT_ENABLED else None
+
+    if args.replay:
+        # Parse again the pages stored by the previous runs, offline: neither iHerb nor Twitter are requested
+        categories = CATEGORIES if args.all else list(dict.fromkeys(args.category))
+        store = page_store.PageStore(PAGE_STORE_PATH)
+        url_lists = [requestiherb.get_stored_url_list(URL + category, store)[:limit] for category in categories]
+        for category, urls in zip(categories, url_lists):
+            print(f"The page store contains {len(urls)} pages of products of the category {category}")
+        url_list = [url for urls in zip_longest(*url_lists) for url in urls if url]
+        sql.preload_id_caches()
+        with metrics.timer("stage_seconds", stage="scrape"):
+            scrape_products(url_list, len(url_list), incremental=args.incremental, replay_store=store,
+                            exporter=exporter)
+        store.close()
+        if exporter is not None:
+            exporter.close()
+        sql.POOL.close()
+        report_metrics()
+        print("THE END")
+        raise SystemExit(0)
+
+    # The replays do not record their progress, only the runs that fetch the pages do
+    checkpoint = checkpoint_store.CheckpointStore(CHECKPOINT_PATH)
+    if args.resume:
+        # Take the pages and options of the interrupted run back from the checkpoint
+        run = checkpoint.load_run()
+        if run is None:
+            print("There is no interrupted run to resume")
+            checkpoint.close()
+            raise SystemExit(1)
+        url_list, options = run
+        incremental = options["incremental"]
+        print(f"Resuming a run of {len(url_list)} pages of products")
+        prefetched = None
+        # The products of the pages persisted before the interruption are not indexed again
+        expected_counts = None
+    else:
+        categories = CATEGORIES if args.all else list(dict.fromkeys(args.category))
+        incremental = args.incremental
+
+        # Create an object of RequestIherb for each category
+        reqs = requestiherb.get_requests([URL + category for category in categories], limit)
+        for req in reqs:
+            print(f"The category {req.url[len(URL):]} contains {min(limit, len(req.url_list))} pages of products")
+
+        # Interleave the pages of the categories, so that all the categories are scraped in parallel
+        url_list = [url for urls in zip_longest(*(req.url_list[:limit] for req in reqs)) for url in urls if url]
+        checkpoint.start_run(url_list, incremental=incremental)
+        # The first page of each category has already been fetched to count its results
+        prefetched = {req.url_list[0]: req.first_page for req in reqs}
+        # The products of a listing are only all found when it is crawled in full and none of its pages is skipped
+        expected_counts = None
+        if not incremental:
+            expected_counts = {req.url: req.nb_result for req in reqs if len(req.url_list) <= limit}
+
+    # Load the ids of the brands, categories and inventory statuses already in the DB
+    sql.preload_id_caches()
+
+    # Fetch, parse and save the products page by page
+    with metrics.timer("stage_seconds", stage="scrape"):
+        brand_names = scrape_products(url_list, len(url_list), incremental=incremental, checkpoint=checkpoint,
+                                      prefetched=prefetched, exporter=exporter, expected_counts=expected_counts)
+    logging.info(f"Retries of the pages served in the wrong version: {requestiherb.RETRY_POLICY.stats()}")
+    # Run the requests on the Twitter API to update the number of tweets of the brands
+    with metrics.timer("stage_seconds", stage="twitter"):
+        run_requests_on_api(brand_names, checkpoint=checkpoint, exporter=exporter)
+    if exporter is not None:
+        exporter.close()
+    checkpoint.finish_run()
+    checkpoint.close()
+    logging.info(f"DB connection pool: {sql.POOL.stats()}")
+    print(f"DB connection pool: {sql.POOL.stats()}")
+    sql.POOL.close()
+    report_metrics()
     print("THE END")
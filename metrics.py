@@ -0,0 +1,194 @@
+import bisect
+import os
+import time
+from contextlib import nullcontext
+
+from settings import config
+
+ENABLED = config["METRICS"]["ENABLED"]
+PROMETHEUS_PATH = config["METRICS"]["PROMETHEUS_PATH"]
+PROMETHEUS_PREFIX = "iherb_"
+# The upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Histogram:
+    """
+    The distribution of a latency, counted in fixed buckets.
+
+    Attributes
+    ----------
+    counts : list of int
+        The number of values of each bucket of BUCKETS, the last one counting the values above the last bound.
+    total : float
+        The sum of the values.
+    count : int
+        The number of values.
+    max : float
+        The largest value.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket of the q-quantile, or the largest value for the last bucket.
+        """
+        rank = q * self.count
+        cumulated = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else 0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "max": round(self.max, 6),
+        }
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe(self._name, time.perf_counter() - self._start, **self._labels)
+
+
+class Registry:
+    """
+    The counters and latency histograms of a run.
+
+    A metric is identified by its name and its labels, e.g. `increment("http_responses", status=200)`.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager observing the duration of its block in the histogram of the name.
+        """
+        return _Timer(self, name, labels)
+
+    def report(self):
+        """
+        Returns the counters and the summary of the histograms, under their name followed by their labels.
+        """
+        return {
+            "counters": {_format_key(name, labels): value for (name, labels), value in sorted(self.counters.items())},
+            "histograms": {_format_key(name, labels): histogram.summary()
+                           for (name, labels), histogram in sorted(self.histograms.items())},
+        }
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = f"{PROMETHEUS_PREFIX}{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = PROMETHEUS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulated = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulated += count
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', bound),))} {cumulated}")
+            lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.total}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a Prometheus text file, e.g. for the textfile collector of the node exporter.
+
+        The file is written under a temporary name first, so that it is never read half-written.
+        """
+        with open(path + ".tmp", "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+
+
+class NullRegistry:
+    """
+    The registry used when the metrics are disabled, whose methods do nothing.
+    """
+
+    counters = {}
+    histograms = {}
+    # A nullcontext can be entered any number of times, so a single one serves every block
+    _timer = nullcontext()
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._timer
+
+    def report(self):
+        return {}
+
+    def write_prometheus(self, path):
+        pass
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_key(name, labels):
+    return name + _format_labels(labels)
+
+
+REGISTRY = Registry() if ENABLED else NullRegistry()
+increment = REGISTRY.increment
+observe = REGISTRY.observe
+timer = REGISTRY.timer
@@ -0,0 +1,92 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS pages (url TEXT NOT NULL, fetched_at REAL NOT NULL, digest TEXT NOT NULL);"
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS pages_url_fetched_at ON pages (url, fetched_at);"
+INSERT_PAGE = "INSERT INTO pages (url, fetched_at, digest) VALUES (?, ?, ?);"
+SELECT_LATEST_DIGEST = "SELECT digest FROM pages WHERE url = ? ORDER BY fetched_at DESC LIMIT 1;"
+SELECT_URLS_WITH_PREFIX = "SELECT DISTINCT url FROM pages WHERE substr(url, 1, ?) = ?;"
+INDEX_FILENAME = "index.sqlite"
+BLOBS_DIRECTORY = "blobs"
+
+
+class PageStore:
+    """
+    An on-disk store of the fetched pages, to parse them again without requesting the website.
+
+    The pages are content-addressed: each distinct content is compressed with gzip once, into a blob named after its
+    SHA-256 digest, whatever the number of times and URLs it was fetched at. A SQLite index records, for each fetch,
+    the URL, the fetch time and the digest of the content.
+
+    Attributes
+    ----------
+    root : str
+        The directory holding the index and the blobs.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._connection = None
+
+    def put(self, url, content):
+        """
+        Stores the content fetched at the URL and returns its digest.
+        """
+        data = content.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # The blob is written under a temporary name first, so an interrupted write never leaves a corrupt blob
+            with gzip.open(path + ".tmp", "wb") as blob:
+                blob.write(data)
+            os.replace(path + ".tmp", path)
+        connection = self._get_connection()
+        with connection:
+            connection.execute(INSERT_PAGE, (url, time.time(), digest))
+        return digest
+
+    def get_latest(self, url):
+        """
+        Returns the content of the last fetch of the URL, or None if it has never been stored.
+        """
+        row = self._get_connection().execute(SELECT_LATEST_DIGEST, (url,)).fetchone()
+        if row is None:
+            return None
+        with gzip.open(self._blob_path(row[0]), "rb") as blob:
+            return blob.read().decode('utf-8')
+
+    def iter_latest(self, urls):
+        """
+        Yields the URL and the content of the last fetch of each given URL that is in the store.
+        """
+        for url in urls:
+            content = self.get_latest(url)
+            if content is not None:
+                yield url, content
+
+    def urls_with_prefix(self, prefix):
+        """
+        Returns the URLs stored that start with the prefix, e.g. every page of a category.
+        """
+        return [row[0] for row in self._get_connection().execute(SELECT_URLS_WITH_PREFIX, (len(prefix), prefix))]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, BLOBS_DIRECTORY, digest[:2], digest + ".gz")
+
+    def _get_connection(self):
+        if self._connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.root, INDEX_FILENAME))
+            with self._connection:
+                self._connection.execute(CREATE_TABLE)
+                self._connection.execute(CREATE_INDEX)
+        return self._connection
@@ -0,0 +1,74 @@
+import sqlite3
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS page_validators (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT);"
+SELECT_VALIDATORS = "SELECT etag, last_modified FROM page_validators WHERE url = ?;"
+UPSERT_VALIDATORS = "INSERT INTO page_validators (url, etag, last_modified) VALUES (?, ?, ?) " \
+                    "ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified;"
+
+
+class PageValidatorStore:
+    """
+    The HTTP validators (ETag and Last-Modified) of the result pages already scraped, stored in a SQLite file.
+
+    They turn the requests of the next run into conditional requests, which the website answers with an empty
+    '304 Not Modified' when the page did not change. The validators of a fetched page are only staged in memory
+    until `commit` is called for it, i.e. once its products are safely in the database, so a page is never skipped
+    on the basis of a run that did not persist it.
+
+    Attributes
+    ----------
+    path : str
+        The path of the SQLite file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.nb_not_modified = 0
+        self._staged = {}
+        self._connection = None
+
+    def conditional_headers(self, url):
+        """
+        Returns the 'If-None-Match' and 'If-Modified-Since' headers matching the stored validators of the URL.
+        """
+        row = self._get_connection().execute(SELECT_VALIDATORS, (url,)).fetchone()
+        if row is None:
+            return {}
+        etag, last_modified = row
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def stage(self, url, response_headers):
+        """
+        Keeps in memory the validators of a freshly fetched page, until they are committed.
+        """
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        if etag or last_modified:
+            self._staged[url] = (etag, last_modified)
+
+    def commit(self, urls):
+        """
+        Stores the staged validators of the given URLs.
+        """
+        rows = [(url,) + self._staged.pop(url) for url in urls if url in self._staged]
+        if rows:
+            connection = self._get_connection()
+            with connection:
+                connection.executemany(UPSERT_VALIDATORS, rows)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            with self._connection:
+                self._connection.execute(CREATE_TABLE)
+        return self._connection
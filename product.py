@@ -1,7 +1,17 @@
+import hashlib
+
+FIELDS = ('url', 'name', 'rating', 'nb_reviews', 'image', 'product_id', 'part_no', 'brand_name', 'brand_id',
+          'discount_price', 'out_of_stock', 'has_discount', 'inventory_status', 'currency', 'price', 'category')
+
+
 class Product:
     """
     A class to represent a product on the iHerb website.
 
+    The attributes are stored in slots rather than in a per-instance dictionary, which saves about a third of the
+    memory used by each product. The numbers and flags are expected to be given with their own type, as the parser does,
+    so that the product can be written to the database or exported as it is.
+
     Attributes
     ----------
     url : str
@@ -14,7 +24,7 @@ class Product:
         The number of reviews for the product.
     image : dict
         A dictionary containing information about the product image.
-    product_id : str
+    product_id : int
         The product ID.
     part_no : str
         The product part number.
@@ -41,8 +51,12 @@ class Product:
     -------
     __str__():
         Returns a string representation of the product.
+    fingerprint():
+        Returns a digest of the fields of the product that change from one day to the next.
     """
 
+    __slots__ = FIELDS
+
     def __init__(self, *, url, name, rating, nb_reviews, image, product_id, part_no, brand_name, brand_id,
                  discount_price, out_of_stock, has_discount, inventory_status, currency, price, category):
         self.url = url
@@ -65,3 +79,13 @@ class Product:
     def __str__(self):
         return f"""{self.name} ({self.url}) - rating: {self.rating}, nb_reviews: {self.nb_reviews}, 
         price: {self.price} {self.currency}"""
+
+    def fingerprint(self):
+        """
+        Returns a digest of the price, discount price, rating, number of reviews and inventory status of the product,
+        which changes whenever one of them does.
+        """
+        content = f"{self.price:.2f}|{self.discount_price:.2f}|{self.rating:.2f}|{self.nb_reviews}|" \
+                  f"{self.inventory_status}"
+        return hashlib.md5(content.encode('utf-8')).hexdigest()
+
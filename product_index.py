@@ -0,0 +1,123 @@
+import metrics
+
+
+def split_page_url(url):
+    """
+    Splits the URL of a result page into the URL of its listing and its page number, e.g. ('.../c/sports', 3), or
+    returns the URL and None if it is not a result page.
+    """
+    listing, _, page = url.rpartition("?p=")
+    if not listing or not page.isdigit():
+        return url, None
+    return listing, int(page)
+
+
+class ProductIndex:
+    """
+    The products found so far by a crawl, by iHerb product id, with the page of each listing they were found on.
+
+    The result pages of a listing shift while they are crawled, as products are added to or removed from the pages
+    before them: a product can then show up on two pages, and another one on none. The index writes every product
+    only once, and detects the drift of the listings whose number of results is known: a product found again on
+    another page of the same listing marks the pages in between as drifted, and a listing with fewer distinct
+    products than its announced number of results has a gap. The pages to fetch again to fill the gaps are given by
+    `pages_to_refetch`.
+
+    Attributes
+    ----------
+    expected_counts : dict
+        The number of results announced by each listing crawled in full, by listing URL. The drift of the other
+        listings is not checked.
+    results_per_page : int
+        The number of products of a full result page.
+    nb_duplicates : int
+        The number of products found again on another page of the same listing.
+    """
+
+    def __init__(self, expected_counts=None, results_per_page=None):
+        self.expected_counts = expected_counts or {}
+        self.results_per_page = results_per_page
+        self.nb_duplicates = 0
+        # The categories each product has been found in so far
+        self._categories = {}
+        # The page each product has first been found on, by listing
+        self._first_pages = {}
+        # The number of products of each page indexed, by listing
+        self._page_sizes = {}
+        self._drifted_pages = {}
+        self._refetched = set()
+
+    def add(self, url, products):
+        """
+        Indexes the products of a result page.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the page.
+        products : list of product.Product
+            The products of the page.
+
+        Returns
+        -------
+        tuple
+            The products found for the first time, and the (product id, category) pairs of the products already
+            found in other categories, which only need to be linked to this one.
+        """
+        listing, page = split_page_url(url)
+        first_pages = self._first_pages.setdefault(listing, {})
+        self._page_sizes.setdefault(listing, {})[page] = len(products)
+        new_products = []
+        links = []
+        for prod in products:
+            first_page = first_pages.setdefault(prod.product_id, page)
+            if page is not None and first_page != page and (listing, page) not in self._refetched:
+                # The product moved to another page between the requests of the two pages
+                self.nb_duplicates += 1
+                metrics.increment("page_drift_duplicates")
+                self._drifted_pages.setdefault(listing, set()).update(
+                    range(min(first_page, page), max(first_page, page) + 1))
+            categories = self._categories.setdefault(prod.product_id, set())
+            if not categories:
+                new_products.append(prod)
+            elif prod.category not in categories:
+                links.append((prod.product_id, prod.category))
+            categories.add(prod.category)
+        return new_products, links
+
+    def missing_counts(self):
+        """
+        Returns the number of products missing from each listing crawled in full, for the listings with a gap.
+        """
+        missing = {}
+        for listing, expected in self.expected_counts.items():
+            found = len(self._first_pages.get(listing, {}))
+            if found < expected:
+                missing[listing] = expected - found
+        return missing
+
+    def pages_to_refetch(self):
+        """
+        Returns the URLs of the pages to fetch again to fill the gaps of the listings, which have not been fetched
+        again yet.
+
+        For a listing with a gap, these are the pages of the listing that were never indexed, as their request
+        failed, then the pages its drift went through. Without any of them, the pages holding fewer products than a
+        full page, the last one aside, are the only lead left.
+        """
+        urls = []
+        for listing in self.missing_counts():
+            page_sizes = self._page_sizes.get(listing, {})
+            nb_pages = -(-self.expected_counts[listing] // self.results_per_page)
+            pages = {page for page in range(1, nb_pages + 1) if page not in page_sizes}
+            pages |= self._drifted_pages.get(listing, set())
+            if not pages:
+                pages = {page for page, size in page_sizes.items() if page < nb_pages and size < self.results_per_page}
+            for page in sorted(pages):
+                if (listing, page) not in self._refetched:
+                    self._refetched.add((listing, page))
+                    urls.append(f"{listing}?p={page}")
+        return urls
+
+    def __len__(self):
+        return len(self._categories)
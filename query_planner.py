@@ -0,0 +1,88 @@
+import re
+
+OR = " OR "
+# The names made of plain words only, which the search matches as they are written
+PLAIN_NAME = re.compile(r"[^\W_]+(?: [^\W_]+)*")
+# The words the search reads as operators
+OPERATORS = {"OR", "AND", "NOT"}
+MIN_NAME_LENGTH = 3
+
+
+def is_ambiguous(name):
+    """
+    Tells whether the tweets of a brand cannot be told apart by matching its name in their text.
+
+    The search tokenizes the names with punctuation differently from a plain text match (e.g. "Nature's Way" also
+    matches "Natures Way"), the very short names match inside many other words and hashtags, and a name containing an
+    operator would change the meaning of the query: the tweets of such brands are searched with a query of their own.
+    """
+    return (len(name) < MIN_NAME_LENGTH or PLAIN_NAME.fullmatch(name) is None
+            or any(word in OPERATORS for word in name.split()))
+
+
+def phrase(name):
+    return f'"{name}"'
+
+
+def build_query(names):
+    """
+    Returns the OR-query matching the tweets of any of the brands, e.g. '"Now Foods" OR "Solgar"'.
+    """
+    return OR.join(phrase(name) for name in names)
+
+
+def plan_queries(names, max_length):
+    """
+    Packs the brands into as few OR-queries as possible, each of at most `max_length` characters.
+
+    The brands are placed from the longest name to the shortest into the first query with enough room left (first
+    fit decreasing), which leaves little room unused.
+
+    Args:
+        names (Iterable[str]): The names of the brands.
+        max_length (int): The maximum length of a query, operators and quotes included.
+
+    Returns:
+        tuple: The groups of brands searched together, each a list of names, and the names searched on their own:
+        the ambiguous ones and the ones too long to be quoted within `max_length`.
+    """
+    groups = []
+    lengths = []
+    singles = []
+    for name in sorted(set(names), key=lambda name: (-len(name), name)):
+        if is_ambiguous(name) or len(phrase(name)) > max_length:
+            singles.append(name)
+            continue
+        for index, length in enumerate(lengths):
+            if length + len(OR) + len(phrase(name)) <= max_length:
+                groups[index].append(name)
+                lengths[index] += len(OR) + len(phrase(name))
+                break
+        else:
+            groups.append([name])
+            lengths.append(len(phrase(name)))
+    return groups, singles
+
+
+class BrandMatcher:
+    """
+    Attributes the tweets found by an OR-query back to the brands it searched, by matching their names as whole
+    phrases in the text of the tweets, ignoring the case.
+
+    Attributes
+    ----------
+    names : list of str
+        The names of the brands.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._patterns = [(name, re.compile(r"(?<!\w)" + r"\s+".join(map(re.escape, name.split())) + r"(?!\w)",
+                                            re.IGNORECASE))
+                          for name in self.names]
+
+    def match(self, text):
+        """
+        Returns the names of the brands mentioned in the text.
+        """
+        return [name for name, pattern in self._patterns if pattern.search(text)]
@@ -1,19 +1,32 @@
-import json
 import logging
+import multiprocessing
+import random
 import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
 
 import grequests
 import requests
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
 
-import product
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
-with open('conf.json', 'r') as f:
-    config = json.load(f)
+import metrics
+import page_store
+import product
+from settings import config
 
 PARSER_TYPE = config["PARSER_TYPE"]
-UA = UserAgent(browsers=config['BROWSERS'])
+# BeautifulSoup still reads the results count, with its own html.parser when the products are parsed by selectolax
+SOUP_PARSER_TYPE = "html.parser" if PARSER_TYPE == "selectolax" else PARSER_TYPE
+BROWSERS = config['BROWSERS']
 URL = config["URL"]
 RESULTS_PER_PAGE = config["RESULTS_PER_PAGE"]
 LOGGING_LEVEL = config["LOGGING_LEVEL"]
@@ -24,6 +37,39 @@ DB_NAME = config["DB_NAME"]
 CATEGORIES = config["CATEGORIES"]
 CATEGORY = "sports"
 DEFAULT_LIMIT = config["DEFAULT_LIMIT"]
+FETCH_CONCURRENCY = config["FETCH"]["CONCURRENCY"]
+MAX_REQUESTS_PER_SECOND_PER_HOST = config["FETCH"]["MAX_REQUESTS_PER_SECOND_PER_HOST"]
+PARSE_WORKERS = config["PARSE_WORKERS"]
+MAX_RETRIES_PER_URL = config["FETCH"]["MAX_RETRIES_PER_URL"]
+RETRY_BUDGET = config["FETCH"]["RETRY_BUDGET"]
+RETRY_BASE_DELAY = config["FETCH"]["RETRY_BASE_DELAY"]
+RETRY_MAX_DELAY = config["FETCH"]["RETRY_MAX_DELAY"]
+REQUEST_TIMEOUT = config["FETCH"]["TIMEOUT"]
+NOT_MODIFIED_CODE = 304
+PAGE_STORE_PATH = config["PAGE_STORE"]["PATH"]
+# The fetched pages are written through this store, to be parsed again offline with the '--replay' mode
+PAGE_STORE = page_store.PageStore(PAGE_STORE_PATH) if config["PAGE_STORE"]["ENABLED"] else None
+
+# One pooled session shared by every fetch, sized so that each concurrent worker can keep its own connection alive
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY))
+SESSION.mount("http://", HTTPAdapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY))
+
+_user_agents = None
+
+
+def get_user_agent():
+    """
+    Returns the user agent of a random browser of BROWSERS.
+
+    The pool of user agents is only built on the first call, as importing fake_useragent takes a noticeable part of
+    the start of the program.
+    """
+    global _user_agents
+    if _user_agents is None:
+        from fake_useragent import UserAgent
+        _user_agents = UserAgent(browsers=BROWSERS)
+    return _user_agents.random
 
 
 class RequestIherb:
@@ -38,6 +84,9 @@ class RequestIherb:
         The total number of search results.
     url_list : list of str
         The URLs for each page of search results.
+    first_page : requests.Response
+        The response of the first page of search results, which gave the number of results. It is reused to parse
+        the products of the first page instead of requesting it again.
 
     Methods
     -------
@@ -51,23 +100,18 @@ class RequestIherb:
 
     def __init__(self, url=URL + CATEGORY, limit=DEFAULT_LIMIT):
         self.url = url
+        self.first_page = None
         self.nb_result = self._get_nb_results()
         self.url_list = self._get_url_list()
         self.products = []
         self.limit = limit
 
     def _get_nb_results(self):
-        span_tag = None
-        # This 'while' has been added to deal with A/B testing that have been implemented in the website after the
-        # begining of the project. It helps us to request the website while we are not on the right version of the page
-        while span_tag is None:
-            html = self._get_page_content()
-            soup = BeautifulSoup(html, PARSER_TYPE)
-            span_tag = soup.find('span', {'class': 'sub-header-title display-items'})
-        text = span_tag.text
-        numbers = re.findall(r'(\d+)\s.*', text)
-        num_result = int(numbers[0])
-        return num_result
+        # The landing page of the category is the first page of results, so it is requested as such and kept
+        self.first_page = _fetch_page(self.url + "?p=1", is_right_version=_has_results_count)
+        if self.first_page is None:
+            raise FetchError(f"Could not get the number of results of {self.url}")
+        return _read_nb_results(self.first_page.content)
 
     def _get_url_list(self):
         nb_pages = int(self.nb_result / RESULTS_PER_PAGE) + 2
@@ -77,88 +121,519 @@ class RequestIherb:
         return list_of_url
 
     def get_detailed_information_from_html(self, html):
-        soup = BeautifulSoup(html, PARSER_TYPE)
-        for item in soup.find_all('div', class_=r'product-inner product-inner-wide'):
-            url = item.a['href']
-            name = item.findNext('div', attrs={'itemprop': "name", 'class': 'product-title'}).text
-            try:
-                rating = float(item.findNext('meta', {'itemprop': 'ratingValue'})['content'])
-                nb_reviews = int(item.findNext('meta', {'itemprop': 'reviewCount'})['content'])
-            except TypeError as e:
-                rating = 0
-                nb_reviews = 0
-                print(f"No rating or review for the product {name}. Exception = {e}")
-            product_id = int(item.a['data-product-id'])
-            part_no = item.a['data-part-number']
-            brand_name = item.a['data-ga-brand-name']
-            brand_id = item.a['data-ga-brand-id']
-            discount_price = float(re.sub(r'[^\d.]', '', item.a['data-ga-discount-price']))
-            out_of_stock = item.a['data-ga-is-out-of-stock']
-            has_discount = item.a['data-ga-is-discontinued']
-            inventory_status = item.a['data-ga-inventory-status']
-            currency = item.findNext('meta', attrs={'itemprop': 'priceCurrency'})['content']
-            price = item.findNext('meta', attrs={'itemprop': 'price'})['content']
-            category = item.findNext('div', attrs={'itemprop': 'category'})['content']
-            self.products.append(
-                product.Product(url=url, name=name, rating=rating, nb_reviews=nb_reviews, image=None,
-                                product_id=product_id,
-                                part_no=part_no, brand_name=brand_name, brand_id=brand_id,
-                                discount_price=discount_price, out_of_stock=out_of_stock, has_discount=has_discount,
-                                inventory_status=inventory_status, currency=currency, price=price, category=category))
+        self.products.extend(parse_products(html))
         return None
 
-    def _get_page_content(self):
+
+def get_requests(urls, limit, concurrency=FETCH_CONCURRENCY):
+    """
+    Creates the RequestIherb of several categories concurrently.
+
+    A category whose first page could not be fetched is logged and left out, like the pages skipped by `iter_html`,
+    instead of stopping the run.
+
+    Parameters
+    ----------
+    urls : list of str
+        The URL of each category.
+    limit : int
+        The maximum number of pages to scrape in each category.
+    concurrency : int
+        The maximum number of categories requested in parallel.
+
+    Returns
+    -------
+    list of RequestIherb
+        The request of each category whose first page could be fetched, in the same order as the input URLs.
+    """
+    def get_request(url):
+        try:
+            return RequestIherb(url, limit)
+        except FetchError as err:
+            print(f"Skipped the category {url}: {err}")
+            logging.error(f"Skipped the category {url}: {err}")
+            return None
+
+    pool = grequests.Pool(concurrency)
+    return [req for req in pool.map(get_request, urls) if req is not None]
+
+
+PRODUCT_CARD_CLASS = 'product-inner product-inner-wide'
+# Only the product cards are built into a tree, the rest of the page is skipped while it is tokenized
+PRODUCT_CARDS = SoupStrainer('div', class_=PRODUCT_CARD_CLASS)
+
+
+def _as_price(value):
+    return float(re.sub(r'[^\d.]', '', value))
+
+
+def _as_bool(value):
+    """
+    Converts a flag of the website ('True', 'false', ...) into a boolean.
+    """
+    return value.strip().lower() == 'true'
+
+
+def _build_product(link, name, properties):
+    """
+    Builds a product from the fields read on its card.
+
+    Parameters
+    ----------
+    link : dict
+        The attributes of the product link of the card.
+    name : str
+        The text of the product title.
+    properties : dict
+        The 'content' of the first tag of the card carrying each 'itemprop'.
+
+    Returns
+    -------
+    product.Product
+        The product of the card.
+    """
+    if properties.get('ratingValue') is None or properties.get('reviewCount') is None:
+        rating = 0.0
+        nb_reviews = 0
+        print(f"No rating or review for the product {name}.")
+    else:
+        rating = float(properties['ratingValue'])
+        nb_reviews = int(properties['reviewCount'])
+    return product.Product(url=link['href'], name=name, rating=rating, nb_reviews=nb_reviews, image=None,
+                           product_id=int(link['data-product-id']),
+                           part_no=link['data-part-number'], brand_name=link['data-ga-brand-name'],
+                           brand_id=link['data-ga-brand-id'],
+                           discount_price=_as_price(link['data-ga-discount-price']),
+                           out_of_stock=_as_bool(link['data-ga-is-out-of-stock']),
+                           has_discount=_as_bool(link['data-ga-is-discontinued']),
+                           inventory_status=link['data-ga-inventory-status'],
+                           currency=properties['priceCurrency'], price=_as_price(properties['price']),
+                           category=properties['category'])
+
+
+def _parse_products_with_soup(html, parser_type=PARSER_TYPE):
+    soup = BeautifulSoup(html, parser_type, parse_only=PRODUCT_CARDS)
+    products = []
+    for item in soup.find_all('div', class_=PRODUCT_CARD_CLASS):
+        name = None
+        properties = {}
+        # A single walk through the card collects every field, instead of one forward search per field
+        for tag in item.find_all(('div', 'meta'), itemprop=True):
+            prop = tag['itemprop']
+            if prop == 'name' and 'product-title' in tag.get('class', ()):
+                if name is None:
+                    name = tag.text
+            elif prop not in properties:
+                properties[prop] = tag.get('content')
+        products.append(_build_product(item.a.attrs, name, properties))
+    return products
+
+
+def _parse_products_with_selectolax(html):
+    if LexborHTMLParser is None:
+        raise ImportError("The 'selectolax' PARSER_TYPE requires the selectolax package")
+    products = []
+    for item in LexborHTMLParser(html).css('div.product-inner.product-inner-wide'):
+        name = None
+        properties = {}
+        for tag in item.css('div[itemprop], meta[itemprop]'):
+            attributes = tag.attributes
+            prop = attributes['itemprop']
+            if prop == 'name' and 'product-title' in (attributes.get('class') or '').split():
+                if name is None:
+                    name = tag.text()
+            elif prop not in properties:
+                properties[prop] = attributes.get('content')
+        products.append(_build_product(item.css_first('a').attributes, name, properties))
+    return products
+
+
+# The extraction engine of each PARSER_TYPE, any other value is used as the BeautifulSoup tree builder
+PRODUCT_PARSERS = {"selectolax": _parse_products_with_selectolax}
+
+
+def parse_products(html, parser_type=PARSER_TYPE):
+    """
+    Extracts detailed information about the products listed in the HTML of a search results page.
+
+    The fields of each product are read in a single pass over its own card, with selectolax when `parser_type` is
+    'selectolax' and with BeautifulSoup and the `parser_type` tree builder ('html.parser', 'lxml', ...) otherwise.
+
+    Parameters
+    ----------
+    html : str
+        The HTML of a search results page.
+    parser_type : str
+        The parser backend to use.
+
+    Returns
+    -------
+    list of product.Product
+        The products of the page, in the order they appear on the page.
+    """
+    if parser_type in PRODUCT_PARSERS:
+        return PRODUCT_PARSERS[parser_type](html)
+    return _parse_products_with_soup(html, parser_type)
+
+
+def _wait_for(future):
+    """
+    Waits for a future of the parsing pool without blocking the pending fetches.
+
+    Blocking on `future.result()` would freeze the gevent hub and therefore every request in flight, so the future is
+    polled with the cooperative (monkey-patched) `time.sleep` instead.
+    """
+    while not future.done():
+        time.sleep(0.005)
+    return future.result()
+
+
+def _timed_parse_products(html):
+    start = time.perf_counter()
+    products = parse_products(html)
+    return products, time.perf_counter() - start
+
+
+def _record_parse(products, seconds):
+    metrics.observe("parse_page_seconds", seconds)
+    metrics.increment("pages_parsed")
+    metrics.increment("products_parsed", len(products))
+    return products
+
+
+def parse_pages(pages, workers=PARSE_WORKERS):
+    """
+    Parses a stream of result pages, fanning the pages out to a pool of processes.
+
+    At most twice as many pages as there are workers are submitted ahead of the one being returned, so the memory stays
+    bounded whatever the number of pages. With one worker or less, the pages are parsed in the current process.
+
+    Parameters
+    ----------
+    pages : iterable of (str, str)
+        The URL and the HTML of each result page, e.g. as yielded by `iter_html`.
+    workers : int
+        The number of parsing processes.
+
+    Yields
+    ------
+    tuple of (str, list of product.Product)
+        The URL and the products of each page, in the same order as the input pages.
+    """
+    if workers <= 1:
+        for url, html in pages:
+            yield url, _record_parse(*_timed_parse_products(html))
+        return
+
+    # The workers are spawned rather than forked: gevent watches the children it forks and the executor could then not
+    # reap them from its management thread
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        in_flight = deque()
+        for url, html in pages:
+            # The parse time is measured in the worker, whose metrics would be lost, and recorded here
+            in_flight.append((url, executor.submit(_timed_parse_products, html)))
+            if len(in_flight) >= 2 * workers:
+                url, future = in_flight.popleft()
+                yield url, _record_parse(*_wait_for(future))
+        while in_flight:
+            url, future = in_flight.popleft()
+            yield url, _record_parse(*_wait_for(future))
+
+
+def _find_results_count(html):
+    soup = BeautifulSoup(html, SOUP_PARSER_TYPE)
+    return soup.find('span', {'class': 'sub-header-title display-items'})
+
+
+def _read_nb_results(html):
+    text = _find_results_count(html).text
+    numbers = re.findall(r'(\d+)\s.*', text)
+    return int(numbers[0])
+
+
+def _has_results_count(response):
+    return _find_results_count(response.content) is not None
+
+
+def _is_not_redirected_to_store(response):
+    return not response.url.endswith("/store")
+
+
+class FetchError(Exception):
+    """
+    Raised when a page could not be fetched in its right version within the retries allowed.
+    """
+
+
+class RetryPolicy:
+    """
+    Decides whether a request that got the wrong version of a page, or no response, is sent again, and how long to
+    wait before.
+
+    The website runs an A/B test and sometimes serves a variant of the pages, or redirects them to '/store'. Such a
+    miss, like a request that failed or timed out, is retried after a jittered exponential backoff: a random delay of up to `base_delay * 2 ** attempt`
+    seconds, capped at `max_delay`. A URL is retried at most `max_retries_per_url` times, and all the URLs of the run
+    share a budget of `budget` retries, so a website that keeps serving the variant cannot stall the run. The sleep is
+    cooperative once grequests has monkey-patched the standard library.
+
+    Attributes
+    ----------
+    max_retries_per_url : int
+        The maximum number of retries of a single URL.
+    budget : int
+        The number of retries left for the whole run.
+    base_delay : float
+        The maximum delay, in seconds, before the first retry.
+    max_delay : float
+        The cap of the delay, in seconds, before any retry.
+    retries : collections.Counter
+        The number of retries of each URL.
+    failures : list of str
+        The URLs given up on.
+    """
+
+    def __init__(self, max_retries_per_url=MAX_RETRIES_PER_URL, budget=RETRY_BUDGET, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY):
+        self.max_retries_per_url = max_retries_per_url
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = Counter()
+        self.failures = []
+
+    def backoff(self, url, attempt):
         """
-        Sends a GET request to the given URL and returns the content of the response.
+        Waits before retrying the URL for the given attempt (0 for the first retry).
 
         Returns
         -------
-        bytes
-            The content of the response.
+        bool
+            True if the URL can be requested again, False if the retries of the URL or of the run are exhausted.
+        """
+        if attempt >= self.max_retries_per_url or self.budget <= 0:
+            self.failures.append(url)
+            return False
+        self.budget -= 1
+        self.retries[url] += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        metrics.increment("fetch_retries")
+        metrics.observe("fetch_retry_sleep_seconds", delay)
+        time.sleep(delay)
+        return True
+
+    def stats(self):
         """
-        headers = {"User-Agent": UA.random}
-        response = requests.get(self.url, headers=headers)
-        html = response.content
-        return html
+        Returns the number of retried URLs, the total number of retries, the retries of the most retried URL, the
+        number of URLs given up on and the retries left in the budget.
+        """
+        return {
+            "retried_urls": len(self.retries),
+            "retries": sum(self.retries.values()),
+            "max_retries_of_an_url": max(self.retries.values(), default=0),
+            "failures": len(self.failures),
+            "budget_left": self.budget,
+        }
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests so that no host receives more than a given number of requests per second.
+
+    Each call to `wait` reserves the next free slot for the host of the URL and sleeps until that slot. The sleep is
+    cooperative once grequests has monkey-patched the standard library, so other fetches keep running meanwhile.
+
+    Attributes
+    ----------
+    interval : float
+        The minimum number of seconds between two requests to the same host. 0 disables the cap.
+    """
+
+    def __init__(self, max_per_second=MAX_REQUESTS_PER_SECOND_PER_HOST):
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            metrics.observe("host_rate_limit_sleep_seconds", slot - now)
+            time.sleep(slot - now)
+
+
+RATE_LIMITER = HostRateLimiter()
+
+
+def _fetch_page(url, validators=None, is_right_version=_is_not_redirected_to_store, retry_policy=RETRY_POLICY):
+    """
+    Fetches a single results page with the shared session, retrying while the website serves the A/B-test variant or
+    the request fails, e.g. if the connection is refused or no data is received for REQUEST_TIMEOUT seconds.
+
+    Parameters
+    ----------
+    url : str
+        The URL to request.
+    validators : page_validators.PageValidatorStore, optional
+        If given, the request is made conditional on the validators stored for the URL.
+    is_right_version : callable, optional
+        Tells whether a response is the right version of the page. By default, any response that was not
+        redirected to '/store'.
+    retry_policy : RetryPolicy, optional
+        The policy the requests getting the wrong version are retried with. Defaults to `RETRY_POLICY`.
+
+    Returns
+    -------
+    requests.Response or None
+        The response of the right version of the page, or a '304 Not Modified' response, or None if the retries
+        have been exhausted.
+    """
+    headers = validators.conditional_headers(url) if validators is not None else {}
+    attempt = 0
+    while True:
+        RATE_LIMITER.wait(url)
+        try:
+            with metrics.timer("http_request_seconds"):
+                response = SESSION.get(url, headers={"User-Agent": get_user_agent(), **headers},
+                                       timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as err:
+            metrics.increment("http_errors", error=type(err).__name__)
+            logging.info(f"Could not get {url}: {err}, attempt {attempt + 1}")
+        else:
+            metrics.increment("http_responses", status=response.status_code)
+            if response.status_code == NOT_MODIFIED_CODE or is_right_version(response):
+                break
+            logging.info(f"Got the wrong version of {url}, attempt {attempt + 1}")
+        if not retry_policy.backoff(url, attempt):
+            metrics.increment("fetch_failures")
+            print(f"Gave up on {url} after {attempt + 1} attempts")
+            logging.error(f"Gave up on {url} after {attempt + 1} attempts")
+            return None
+        attempt += 1
+    print(f"Got response from {response.url}")
+    logging.info(f"Got response from {response.url}")
+    return response
+
+
+def iter_html(urls, limit, concurrency=FETCH_CONCURRENCY, validators=None, store=PAGE_STORE, prefetched=None):
+    """
+    Sends GET requests to the given URLs concurrently and yields the content of each response as soon as it is ready.
+
+    At most `concurrency` requests are in flight at the same time, all sharing the pooled `SESSION`, and the
+    `RATE_LIMITER` caps the number of requests per second sent to each host. No more than `concurrency` fetched pages
+    wait for the consumer: the requests pause while it is busy, so the memory held by the pages does not grow with the
+    number of pages, however slow the consumer is.
+
+    Parameters
+    ----------
+    urls : list of str
+        The URLs to request.
+    limit: maximum number of pages to parse
+    concurrency : int
+        The maximum number of requests sent in parallel.
+    validators : page_validators.PageValidatorStore, optional
+        If given, the pages are requested conditionally: the pages the website reports as not modified since the
+        stored validators are skipped, and the validators of the other pages are staged in the store.
+    store : page_store.PageStore, optional
+        The store the content of each fetched page is written to. Defaults to `PAGE_STORE`.
+    prefetched : dict of str to requests.Response, optional
+        The responses of pages already fetched, e.g. the first page of a category, which are not requested again.
+
+    Yields
+    ------
+    tuple of (str, str)
+        The URL and the content of its response, in the same order as the input URLs. The pages that could not be
+        fetched in their right version are skipped.
+    """
+    prefetched = dict(prefetched or {})
+    pool = grequests.Pool(concurrency)
+    # Pool.imap yields the responses in the order of the input URLs, whatever order they complete in, and maxsize bounds
+    # the responses it buffers ahead of the consumer
+    responses = pool.imap(lambda url: prefetched.pop(url, None) or _fetch_page(url, validators), urls[:limit],
+                          maxsize=concurrency)
+    for url, response in zip(urls[:limit], responses):
+        if response is None:
+            continue
+        if response.status_code == NOT_MODIFIED_CODE:
+            metrics.increment("pages_not_modified")
+            validators.nb_not_modified += 1
+            logging.info(f"Skipped {url}, not modified since the last run")
+            continue
+        if validators is not None:
+            validators.stage(url, response.headers)
+        print(f"Extracted content from {response.url}")
+        logging.info(f"Extracted content from {response.url}")
+        content = response.content.decode('utf-8')
+        if store is not None:
+            store.put(url, content)
+        yield url, content
 
 
-def get_html(urls, limit):
+def get_html(urls, limit, concurrency=FETCH_CONCURRENCY):
     """
-    Sends GET requests to the given URLs using grequests and returns the content of the responses.
+    Sends GET requests to the given URLs concurrently and returns the content of the responses.
 
     Parameters
     ----------
     urls : list of str
         The URLs to request.
     limit: maximum number of pages to parse
+    concurrency : int
+        The maximum number of requests sent in parallel.
 
     Returns
     -------
     list of str
         The content of the responses, in the same order as the input URLs.
     """
-    responses = []
-    for index, url in enumerate(urls):
-        if index < limit:
-            request = grequests.get(url)
-            response = request.send()
-            # This 'while' has been added to deal with A/B testing that have been implemented in the website after the
-            # begining of the project. It helps us to request the website while we are not on the right version of the
-            # page
-            while response.response.url.endswith("/store"):
-                request = grequests.get(url)
-                response = request.send()
-            responses.append(response)
-            print(f"Got response from {response.url}")
-            logging.info(f"Got response from {response.url}")
-        else:
-            break
-
-    # Extract the content of each response and print it
-    contents = []
-    for obj in responses:
-        content = obj.response.content.decode('utf-8')
-        contents.append(content)
-        print(f"Extracted content from {obj.url}")
-        logging.info(f"Extracted content from {obj.url}")
-    return contents
+    return [content for _, content in iter_html(urls, limit, concurrency)]
+
+
+def get_stored_url_list(url, store):
+    """
+    Returns the URLs of the result pages of a category that are in the page store.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the category.
+    store : page_store.PageStore
+        The store the pages have been written to.
+
+    Returns
+    -------
+    list of str
+        The URLs of the stored pages, sorted by page number.
+    """
+    urls = store.urls_with_prefix(url + "?p=")
+    return sorted(urls, key=lambda page_url: int(page_url.rsplit("=", 1)[1]))
+
+
+def iter_stored_html(urls, limit, store):
+    """
+    Yields the content of the given result pages from the page store, as last fetched, without requesting the website.
+
+    Parameters
+    ----------
+    urls : list of str
+        The URLs of the pages.
+    limit: maximum number of pages to parse
+    store : page_store.PageStore
+        The store the pages have been written to.
+
+    Yields
+    ------
+    tuple of (str, str)
+        The URL and the stored content of each page, in the same order as the input URLs. The pages that are not in
+        the store are skipped.
+    """
+    for url, content in store.iter_latest(urls[:limit]):
+        logging.info(f"Replayed content of {url} from the page store")
+        yield url, content
@@ -0,0 +1,110 @@
+import json
+
+CONFIG_PATH = 'conf.json'
+NUMBER = (int, float)
+# The type of each setting, the sections being checked key by key
+SCHEMA = {
+    "URL": str,
+    "PARSER_TYPE": str,
+    "PARSE_WORKERS": int,
+    "BROWSERS": list,
+    "LOGGING_LEVEL": str,
+    "RESULTS_PER_PAGE": int,
+    "FETCH": {
+        "CONCURRENCY": int,
+        "MAX_REQUESTS_PER_SECOND_PER_HOST": NUMBER,
+        "MAX_RETRIES_PER_URL": int,
+        "RETRY_BUDGET": int,
+        "RETRY_BASE_DELAY": NUMBER,
+        "RETRY_MAX_DELAY": NUMBER,
+        "TIMEOUT": NUMBER,
+    },
+    "DATABASE": {
+        "HOST": str,
+        "USER": str,
+        "PASSWORD": str,
+        "DB": str,
+        "CHARSET": str,
+        "POOL_SIZE": int,
+        "POOL_TIMEOUT": NUMBER,
+        "HEALTH_CHECK_INTERVAL": NUMBER,
+    },
+    "TWITTER_REQUEST_PARAMETERS": {
+        "LATITUDE": str,
+        "LONGITUDE": str,
+        "RESULT_TYPE": str,
+        "RADIUS": str,
+        "MAX_TWEETS": int,
+        "REQUEST_ACCEPTED_CODE": int,
+        "CONCURRENCY": int,
+        "RATE_LIMIT": int,
+        "RATE_LIMIT_WINDOW": NUMBER,
+        "STREAM_JSON": bool,
+    },
+    "TWEET_CACHE": {"PATH": str, "TTL": NUMBER, "MAX_ENTRIES": int},
+    "TWEET_WATERMARKS": {"ENABLED": bool},
+    "TWEET_QUERY_BATCHING": {"ENABLED": bool, "MAX_QUERY_LENGTH": int},
+    "TWEETS_FLUSH": {"SIZE": int, "INTERVAL": NUMBER},
+    "TIME_SLEEP": NUMBER,
+    "DB_NAME": str,
+    "DEFAULT_LIMIT": int,
+    "DB_BATCH_SIZE": int,
+    "CHECKPOINT_PATH": str,
+    "PAGE_DRIFT": {"REFETCH_ROUNDS": int},
+    "PAGE_STORE": {"ENABLED": bool, "PATH": str},
+    "PRODUCT_SNAPSHOTS": {"ENABLED": bool, "ONLY_ON_CHANGE": bool},
+    "METRICS": {"ENABLED": bool, "PROMETHEUS_PATH": (str, type(None))},
+    "EXPORT": {"ENABLED": bool, "PATH": str, "BATCH_SIZE": int, "COMPRESSION": str},
+    "INCREMENTAL": {"PAGE_VALIDATORS_PATH": str},
+    "CATEGORIES": list,
+    "LOG_FILENAME": str,
+    "LOG_FORMAT": str,
+}
+
+
+class ConfigError(Exception):
+    """
+    Raised when the configuration file misses a setting or gives a setting a value of the wrong type.
+    """
+
+
+def _validate(values, schema, path=""):
+    errors = []
+    for key, expected in schema.items():
+        name = path + key
+        if key not in values:
+            errors.append(f"missing setting {name}")
+        elif isinstance(expected, dict):
+            if isinstance(values[key], dict):
+                errors.extend(_validate(values[key], expected, name + "."))
+            else:
+                errors.append(f"{name} must be a section")
+        # bool is a subclass of int, but a flag is no number
+        elif not isinstance(values[key], expected) or (isinstance(values[key], bool) and expected is not bool):
+            errors.append(f"{name} has the wrong type: {type(values[key]).__name__}")
+    return errors
+
+
+def load(path=CONFIG_PATH):
+    """
+    Reads and validates the configuration file.
+
+    Args:
+        path (str, optional): The path of the configuration file. Defaults to CONFIG_PATH.
+
+    Returns:
+        dict: The settings.
+
+    Raises:
+        ConfigError: If a setting is missing or has the wrong type, listing all of them.
+    """
+    with open(path, 'r') as f:
+        values = json.load(f)
+    errors = _validate(values, SCHEMA)
+    if errors:
+        raise ConfigError(f"Invalid configuration file {path}: " + "; ".join(errors))
+    return values
+
+
+# Loaded once, when the first module needing the settings is imported
+config = load()
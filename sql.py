@@ -1,30 +1,194 @@
+import contextvars
 import logging
+import time
 import pymysql.cursors
-import json
+from contextlib import contextmanager
 
-INSERT_CATEGORY = "INSERT INTO category (category,description) VALUES (\"{cat}\",\"\");"
-INSERT_BRAND = "INSERT INTO brands (name) VALUES (\"{brand}\");"
-INSERT_STATUS = "INSERT INTO inventory_status (state) VALUES (\"{status}\");"
+import dbpool
+import metrics
+from settings import config
+
+POOL_SIZE = config['DATABASE']['POOL_SIZE']
+POOL_TIMEOUT = config['DATABASE']['POOL_TIMEOUT']
+HEALTH_CHECK_INTERVAL = config['DATABASE']['HEALTH_CHECK_INTERVAL']
+TWEETS_FLUSH_SIZE = config['TWEETS_FLUSH']['SIZE']
+TWEETS_FLUSH_INTERVAL = config['TWEETS_FLUSH']['INTERVAL']
+
+INSERT_CATEGORY = "INSERT IGNORE INTO category (category, description) VALUES (%s, '');"
+INSERT_BRAND = "INSERT IGNORE INTO brands (name) VALUES (%s);"
+INSERT_STATUS = "INSERT IGNORE INTO inventory_status (state) VALUES (%s);"
 COUNT_PRODUCT_WITH_IHERB_ID = "SELECT COUNT(*) AS NUM_RESULT FROM product WHERE product.iherb_product_id={product_id};"
 SELECT_BRAND_ID = "SELECT id FROM brands WHERE brands.name='{brand_name}'"
-SELECT_BRAND_WITH_NAME = "SELECT id FROM brands WHERE brands.name={brand_name}"
-INSERT_INTO_PRODUCT = "INSERT INTO `product` (`iherb_product_id`, `url`, `name`, `rating`,`number_reviews`,`part_no`," \
-                      "`brand_id`, `discount_price`, `out_of_stock`, `inventory_status_id`, `currency`, `price`) " \
-                      "VALUES ({product_id}, '{url}', '{prod_name}', {rating}, {nb_reviews},'{part_no}',{brand_id}," \
-                      "{discount_price}, {out_of_stock},{inventory_status},'{currency}', {price});"
-UPDATE_PRODUCT = "UPDATE product SET number_reviews ={nb_reviews}, rating ={rating} WHERE iherb_product_id = {" \
-                 "product_id};"
-SELECT_CATEGORY_ID = "SELECT id FROM category WHERE category.category='{category}'"
-SELECT_PRODUCT_ID_USING_IHERB_ID = "SELECT id FROM product WHERE product.iherb_product_id='{product_id}'"
-INSERT_PRODUCT_CATEGORY = "INSERT INTO `product_category` (`product_id`, `category_id`) VALUES ({product_id}," \
-                          "{category_id})"
-UPDATE_BRAND_TWEETS_QTY = "UPDATE brands SET number_of_tweets ={tweets} WHERE id={brand_id};"
+SELECT_BRAND_IDS = "SELECT id, name AS `key` FROM brands WHERE name IN ({keys});"
+SELECT_CATEGORY_IDS = "SELECT id, category AS `key` FROM category WHERE category IN ({keys});"
+SELECT_STATUS_IDS = "SELECT id, state AS `key` FROM inventory_status WHERE state IN ({keys});"
+SELECT_PRODUCT_IDS = "SELECT id, iherb_product_id AS `key` FROM product WHERE iherb_product_id IN ({keys});"
+SELECT_ALL_BRAND_IDS = "SELECT id, name AS `key` FROM brands;"
+SELECT_ALL_CATEGORY_IDS = "SELECT id, category AS `key` FROM category;"
+SELECT_ALL_STATUS_IDS = "SELECT id, state AS `key` FROM inventory_status;"
+UPSERT_PRODUCT = "INSERT INTO `product` (`iherb_product_id`, `url`, `name`, `rating`, `number_reviews`, `part_no`, " \
+                 "`brand_id`, `discount_price`, `out_of_stock`, `inventory_status_id`, `currency`, `price`, " \
+                 "`fingerprint`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " \
+                 "ON DUPLICATE KEY UPDATE `number_reviews` = VALUES(`number_reviews`), `rating` = VALUES(`rating`), " \
+                 "`discount_price` = VALUES(`discount_price`), `out_of_stock` = VALUES(`out_of_stock`), " \
+                 "`inventory_status_id` = VALUES(`inventory_status_id`), `price` = VALUES(`price`), " \
+                 "`fingerprint` = VALUES(`fingerprint`);"
+SELECT_FINGERPRINTS = "SELECT iherb_product_id, fingerprint FROM product WHERE iherb_product_id IN ({product_ids});"
+INSERT_PRODUCT_SNAPSHOT = "INSERT IGNORE INTO `product_snapshot` (`product_id`, `run_ts`, `price`, `discount_price`, " \
+                          "`out_of_stock`, `rating`, `number_reviews`) VALUES (%s, %s, %s, %s, %s, %s, %s);"
+INSERT_PRODUCT_CATEGORY = "INSERT IGNORE INTO `product_category` (`product_id`, `category_id`) VALUES (%s, %s);"
+SAVEPOINT_PRODUCT_BATCH = "SAVEPOINT product_batch;"
+ROLLBACK_PRODUCT_BATCH = "ROLLBACK TO SAVEPOINT product_batch;"
+UPDATE_BRAND_TWEETS_QTY = "UPDATE brands SET number_of_tweets = CASE id {cases} END, " \
+                          "tweets_since_id = CASE id {cases} END WHERE id IN ({brand_ids});"
+BRAND_TWEETS_QTY_CASE = "WHEN %s THEN %s"
 SELECT_BRANDS_FROM_REQ = "SELECT * from brands where name in ({brands});"
 
 
+class InstrumentedCursor(pymysql.cursors.DictCursor):
+    """
+    A cursor recording the duration of each round trip to the server and the number of rows written in batches.
+
+    `executemany` sends a multi-row INSERT as one statement per chunk of `max_stmt_length` bytes, each of them going
+    through `execute`, so the round trips are counted whatever the way the statements are sent.
+    """
+
+    def execute(self, query, args=None):
+        with metrics.timer("db_round_trip_seconds"):
+            return super().execute(query, args)
+
+    def executemany(self, query, args):
+        metrics.increment("db_rows_written", len(args))
+        return super().executemany(query, args)
+
+
+def _connect():
+    """
+    Opens a new connection to the MySQL database described in the 'DATABASE' section of the configuration file.
+    """
+    return pymysql.connect(
+        host=config['DATABASE']['HOST'],
+        user=config['DATABASE']['USER'],
+        password=config['DATABASE']['PASSWORD'],
+        db=config['DATABASE']['DB'],
+        charset=config['DATABASE']['CHARSET'],
+        cursorclass=InstrumentedCursor if metrics.ENABLED else pymysql.cursors.DictCursor
+    )
+
+
+POOL = dbpool.ConnectionPool(_connect, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                             health_check_interval=HEALTH_CHECK_INTERVAL)
+
+# The cursor of the unit of work in progress in the current thread or greenlet, if any
+_current_cursor = contextvars.ContextVar('current_cursor', default=None)
+
+
+class IdCache:
+    """
+    An in-memory map from the natural key of the rows of a table (brand name, category, iHerb product id, ...) to
+    their id in the DB.
+
+    The map is filled lazily: `load` only queries the keys it does not know yet, so once a key has been seen its id
+    never has to be looked up again during the run.
+
+    Attributes
+    ----------
+    select_query : str
+        The query returning the 'id' and 'key' of the rows whose key is in the '{keys}' placeholders.
+    normalize : callable
+        Turns a key into the form used in the map, e.g. lower case for the names MySQL compares case-insensitively.
+    """
+
+    def __init__(self, select_query, normalize):
+        self.select_query = select_query
+        self.normalize = normalize
+        self._ids = {}
+
+    def get(self, key):
+        return self._ids.get(self.normalize(key))
+
+    def missing(self, keys):
+        """
+        Returns the keys, without duplicates, whose id is not in the cache.
+        """
+        missing = {}
+        for key in keys:
+            normalized = self.normalize(key)
+            if normalized not in self._ids:
+                missing.setdefault(normalized, key)
+        return list(missing.values())
+
+    def add(self, rows):
+        """
+        Adds the 'id' and 'key' of the given rows to the cache.
+        """
+        for row in rows:
+            self._ids[self.normalize(row['key'])] = row['id']
+
+    def load(self, curs, keys):
+        """
+        Looks up in the DB, with a single query, the ids of the keys that are not in the cache yet.
+        """
+        missing = self.missing(keys)
+        if missing:
+            curs.execute(self.select_query.format(keys=_placeholders(missing)), missing)
+            self.add(curs.fetchall())
+
+    def clear(self):
+        self._ids.clear()
+
+
+BRAND_IDS = IdCache(SELECT_BRAND_IDS, normalize=str.lower)
+CATEGORY_IDS = IdCache(SELECT_CATEGORY_IDS, normalize=str.lower)
+STATUS_IDS = IdCache(SELECT_STATUS_IDS, normalize=str.lower)
+PRODUCT_IDS = IdCache(SELECT_PRODUCT_IDS, normalize=int)
+ID_CACHES = (BRAND_IDS, CATEGORY_IDS, STATUS_IDS, PRODUCT_IDS)
+
+
+def clear_id_caches():
+    """
+    Empties every id cache, e.g. after a rollback that may have undone the insertion of cached rows.
+    """
+    for cache in ID_CACHES:
+        cache.clear()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    A context manager that makes every decorated function called inside the block share one connection and one
+    transaction.
+
+    The transaction is committed when the block exits normally and rolled back if it raises. Nested units of work
+    join the outermost one.
+
+    Example:
+        with unit_of_work():
+            insert_brands_into_db(products)
+            insert_product_into_db(products)
+        # both inserts are committed together here
+    """
+    if _current_cursor.get() is not None:
+        yield
+        return
+    with POOL.connection() as connection:
+        curs = connection.cursor()
+        token = _current_cursor.set(curs)
+        try:
+            yield
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            clear_id_caches()
+            raise
+        finally:
+            _current_cursor.reset(token)
+            curs.close()
+
+
 def connect_to_pymysql(func):
     """
-    A decorator that connects to a MySQL database and passes a cursor object to the decorated function.
+    A decorator that passes a cursor object on a pooled MySQL connection to the decorated function.
 
     Args:
         func (callable): The function to decorate.
@@ -33,17 +197,18 @@ def connect_to_pymysql(func):
         callable: The decorated function.
 
     Raises:
+        dbpool.PoolTimeoutError: If no connection of the pool became free in time.
         Any error that can be raised by pymysql.connect().
 
     Example:
         @connect_to_pymysql
-        def my_function(curs, sql_queries, arg1, arg2, kwarg1=None, kwarg2=None):
-            # Use the curs object to execute SQL queries and the sql_queries object to access pre-defined queries.
+        def my_function(curs, arg1, arg2, kwarg1=None, kwarg2=None):
+            # Use the curs object to execute SQL queries.
             # ...
 
     Notes:
-        This decorator reads the connection parameters from a 'conf.json' file located in the current working
-        directory. The 'conf.json' file should have the following format:
+        The connection parameters are read from the 'DATABASE' section of the 'conf.json' file located in the
+        current working directory:
 
         {
             "DATABASE": {
@@ -51,45 +216,36 @@ def connect_to_pymysql(func):
                 "USER": "my_user",
                 "PASSWORD": "mypassword",
                 "DB": "my_database",
-                "CHARSET": "utf8mb4"
+                "CHARSET": "utf8mb4",
+                "POOL_SIZE": 5,
+                "POOL_TIMEOUT": 30,
+                "HEALTH_CHECK_INTERVAL": 60
             }
         }
 
-        The 'func' parameter should accept at least two parameters: 'curs' and 'sql_queries'. 'curs' is a pymysql
-        cursor object that can be used to execute SQL queries. 'sql_queries' is an instance of the SQLQueries class
-        defined in the 'sql_queries.py' module, which can be used to access pre-defined SQL queries stored in a JSON
-        file.
-
-        This decorator automatically commits changes to the database in case of SQL queries that modify the data
-        (e.g. INSERT, UPDATE, DELETE). If an error occurs during the commit, the changes are rolled back.
-
-        The connection and cursor objects are closed automatically after the decorated function is executed.
-
-        This decorator ensures that a new connection to the database is created every time a function is decorated.
+        Inside a `unit_of_work()` block, the decorated function uses the cursor of the unit of work and leaves the
+        commit to it. Otherwise, a connection is borrowed from the pool, the changes are committed after the call
+        (or rolled back if it raises) and the connection is handed back to the pool.
     """
 
     def wrapper(*args, **kwargs):
-        # get parameters from configurations file
-        with open('conf.json', 'r') as f:
-            config = json.load(f)
-        # create a connection to the MySQL database
-        connection = pymysql.connect(
-            host=config['DATABASE']['HOST'],
-            user=config['DATABASE']['USER'],
-            password=config['DATABASE']['PASSWORD'],
-            db=config['DATABASE']['DB'],
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        # create a cursor object from the connection
-        curs = connection.cursor()
-        # pass the cursor as a parameter to the decorated function
-        result = func(curs, *args, **kwargs)
-        # Commit changes to the database in case of sql queries such as: INSERT, UPDATE, or DELETE.
-        connection.commit()
-        # close the cursor and connection after the function call is completed
-        curs.close()
-        connection.close()
-        return result
+        with metrics.timer("db_call_seconds", function=func.__name__):
+            curs = _current_cursor.get()
+            if curs is not None:
+                return func(curs, *args, **kwargs)
+            with POOL.connection() as connection:
+                curs = connection.cursor()
+                try:
+                    result = func(curs, *args, **kwargs)
+                    # Commit changes to the database in case of sql queries such as: INSERT, UPDATE, or DELETE.
+                    connection.commit()
+                except BaseException:
+                    connection.rollback()
+                    clear_id_caches()
+                    raise
+                finally:
+                    curs.close()
+            return result
 
     return wrapper
 
@@ -97,183 +253,225 @@ def connect_to_pymysql(func):
 @connect_to_pymysql
 def insert_categories_into_db(curs, products):
     """
-    inserts the categories of the products into the DB
+    inserts the categories of the products that are not in the DB yet and caches their ids
     :param products: List of products
     :param curs: curso object
     :return: None
     """
-    categories = {p.category for p in products}
-    for cat in categories:
-        try:
-            curs.execute(INSERT_CATEGORY.format(cat=cat))
-        except pymysql.err.IntegrityError as err:
-            logging.info(err)
+    categories = CATEGORY_IDS.missing(p.category for p in products)
+    if categories:
+        curs.executemany(INSERT_CATEGORY, [(cat,) for cat in categories])
+        CATEGORY_IDS.load(curs, categories)
 
 
 @connect_to_pymysql
 def insert_brands_into_db(curs, products):
     """
-    inserts the brands of the products into the DB
+    inserts the brands of the products that are not in the DB yet and caches their ids
     :param products: List of products
     :param curs: curso object
     :return: None
     """
-    brands = {p.brand_name for p in products}
-    for brand in brands:
-        try:
-            curs.execute(INSERT_BRAND.format(brand=brand))
-        except pymysql.err.IntegrityError as err:
-            logging.info(err)
+    brands = BRAND_IDS.missing(p.brand_name for p in products)
+    if brands:
+        curs.executemany(INSERT_BRAND, [(brand,) for brand in brands])
+        BRAND_IDS.load(curs, brands)
 
 
 @connect_to_pymysql
 def insert_inventory_status_into_db(curs, products):
     """
-    inserts the inventory status of the products into the DB
+    inserts the inventory status of the products that are not in the DB yet and caches their ids
     :param products: List of products
     :param curs: curso object
     :return: None
     """
-    inventory_status = {p.inventory_status for p in products}
-    for status in inventory_status:
-        try:
-            curs.execute(INSERT_STATUS.format(status=status))
-        except pymysql.err.IntegrityError as err:
-            logging.info(err)
+    inventory_status = STATUS_IDS.missing(p.inventory_status for p in products)
+    if inventory_status:
+        curs.executemany(INSERT_STATUS, [(status,) for status in inventory_status])
+        STATUS_IDS.load(curs, inventory_status)
 
 
-@connect_to_pymysql
-def insert_product_into_db(curs, products):
+def _placeholders(values):
     """
-    inserts the products into the DB
-    :param products: List of products
-    :param curs: curso object
-    :return: None
+    Returns the placeholders of a parameterized 'IN (...)' clause for the given values.
     """
-    for prod in products:
-        curs.execute(SELECT_PRODUCT_ID_USING_IHERB_ID.format(product_id=prod.product_id))
-        if curs.fetchone() is None:
-            create_new_product(prod)
-        else:
-            update_existing_product(prod)
+    return ", ".join(["%s"] * len(values))
+
 
-        populate_product_category(prod)
+def _link_products_to_categories(curs, links):
+    """
+    Associates products with categories, using the id caches to turn the iHerb product ids and category names into
+    ids. The products and categories must already be in the DB.
+    """
+    PRODUCT_IDS.load(curs, (product_id for product_id, _ in links))
+    CATEGORY_IDS.load(curs, (category for _, category in links))
+    rows = {(PRODUCT_IDS.get(product_id), CATEGORY_IDS.get(category)) for product_id, category in links}
+    curs.executemany(INSERT_PRODUCT_CATEGORY, [row for row in rows if None not in row])
+
+
+def _append_snapshots(curs, products, snapshot_at):
+    """
+    Appends a row of the price history of each product, the products being already in the DB.
+    """
+    PRODUCT_IDS.load(curs, (prod.product_id for prod in products))
+    rows = []
+    for prod in products:
+        product_id = PRODUCT_IDS.get(prod.product_id)
+        if product_id is not None:
+            rows.append((product_id, snapshot_at, prod.price, prod.discount_price, prod.out_of_stock, prod.rating,
+                         prod.nb_reviews))
+    if rows:
+        curs.executemany(INSERT_PRODUCT_SNAPSHOT, rows)
 
 
 @connect_to_pymysql
-def create_new_product(curs, prod):
+def insert_product_into_db(curs, products, snapshot_at=None, snapshot_ids=None):
     """
-    Inserts a new product record into the database using the given product object and database cursor.
+    Inserts a batch of products into the DB, or updates the prices, stock, rating and number of reviews of the
+    products that are already there, and associates them with their category.
+
+    The whole batch is written with parameterized multi-row statements over a single connection and committed as one
+    transaction: one upsert writes the products (relying on the unique index on `product.iherb_product_id`) and one
+    insert links them to their category. The ids of the brands, categories and products come from the id caches,
+    so only the products never seen before during the run are looked up, with one query for the whole batch.
+
+    With a snapshot time, one more insert appends the current values of the products to the `product_snapshot`
+    price history, in the same transaction.
 
     Args:
-        prod (Product): The product object to insert.
+        products (List[Product]): The products to insert or update. Their brands and categories must already be in
+            the DB.
         curs: The database cursor to use for executing SQL queries.
+        snapshot_at (datetime, optional): The time of the snapshot rows, i.e. the start of the run. No snapshot is
+            written when it is None.
+        snapshot_ids (set, optional): The iHerb ids of the products to take a snapshot of. All of them when None.
 
     Returns:
-        None
+        bool: True if the batch has been written, False if it has been rolled back.
 
     Raises:
-        pymysql.err.Error: If there is an error executing the SQL query.
+        pymysql.err.Error: If there is an error looking up the ids. An error while writing the batch is logged
+        and the batch is rolled back.
     """
+    if not products:
+        return True
+    BRAND_IDS.load(curs, (prod.brand_name for prod in products))
+    CATEGORY_IDS.load(curs, (prod.category for prod in products))
+
+    rows = []
+    for prod in products:
+        brand_id = BRAND_IDS.get(prod.brand_name)
+        if brand_id is None:
+            logging.info(f"""The product {str(prod)} has not been inserted into DB. Cause: unknown brand""")
+            continue
+        rows.append((prod.product_id, prod.url, prod.name, prod.rating, prod.nb_reviews, prod.part_no, brand_id,
+                     prod.discount_price, prod.out_of_stock, prod.inventory_status, prod.currency,
+                     prod.price, prod.fingerprint()))
+    # The batch is rolled back on its own, without undoing what the unit of work it may belong to already wrote
+    curs.execute(SAVEPOINT_PRODUCT_BATCH)
     try:
-        brand_name = '"' + prod.brand_name + '"'
-        curs.execute(SELECT_BRAND_WITH_NAME.format(brand_name=brand_name))
-        result = curs.fetchall()
-        brand_id = result[0]['id']
-        prod_name = prod.name.replace("'", " ")
-        curs.execute(INSERT_INTO_PRODUCT.format(product_id=prod.product_id, url=prod.url, prod_name=prod_name,
-                                                rating=prod.rating, nb_reviews=prod.nb_reviews,
-                                                part_no=prod.part_no, brand_id=brand_id,
-                                                discount_price=prod.discount_price, out_of_stock=prod.out_of_stock,
-                                                inventory_status=prod.inventory_status, currency=prod.currency,
-                                                price=prod.price))
+        curs.executemany(UPSERT_PRODUCT, rows)
+        _link_products_to_categories(curs, [(prod.product_id, prod.category) for prod in products])
+        if snapshot_at is not None:
+            snapshots = [prod for prod in products if snapshot_ids is None or prod.product_id in snapshot_ids]
+            _append_snapshots(curs, snapshots, snapshot_at)
     except pymysql.err.Error as e:
-        logging.info(f"""The product {str(prod)} has not been inserted into DB. Cause {e}""")
+        curs.execute(ROLLBACK_PRODUCT_BATCH)
+        # The ids of the products created by the batch are gone with it
+        PRODUCT_IDS.clear()
+        logging.error(f"""FAIL : batch of {len(products)} products rolled back. CAUSE : {e}""")
+        print(f"INSERT FAILED for a batch of {len(products)} products !!!")
+        return False
+    return True
 
 
 @connect_to_pymysql
-def update_existing_product(curs, prod):
+def insert_product_categories(curs, links):
     """
-    Updates an existing product record in the database with the given product object and database cursor.
+    Associates products already in the DB with more categories, e.g. the products scraped in several categories
+    during the same run, which are only written once.
 
     Args:
-        prod (Product): The product object to update.
+        links (List[Tuple[int, str]]): The iHerb product id and the category name of each association.
         curs: The database cursor to use for executing SQL queries.
 
     Returns:
         None
+    """
+    if not links:
+        return
+    categories = CATEGORY_IDS.missing(category for _, category in links)
+    if categories:
+        curs.executemany(INSERT_CATEGORY, [(cat,) for cat in categories])
+        CATEGORY_IDS.load(curs, categories)
+    _link_products_to_categories(curs, links)
 
-    Raises:
-        pymysql.err.Error: If there is an error executing the SQL query.
+
+@connect_to_pymysql
+def filter_changed_products(curs, products):
     """
-    try:
-        curs.execute(
-            UPDATE_PRODUCT.format(nb_reviews=prod.nb_reviews, rating=prod.rating, product_id=prod.product_id))
-    except pymysql.err.Error as e:
-        logging.info(
-            f"""FAIL : {UPDATE_PRODUCT.format(nb_reviews=prod.nb_reviews, rating=prod.rating,
-                                              product_id=prod.product_id)} CAUSE : {e}""")
-        print(f"UPDATE FAILED for {prod.product_id} !!!")
+    Returns the products that are new or whose fingerprint differs from the one stored in the DB.
+
+    Args:
+        products (List[Product]): The scraped products.
+        curs: The database cursor to use for executing SQL queries.
+
+    Returns:
+        List[Product]: The products that have to be written, in the same order.
+    """
+    if not products:
+        return []
+    product_ids = list({prod.product_id for prod in products})
+    curs.execute(SELECT_FINGERPRINTS.format(product_ids=_placeholders(product_ids)), product_ids)
+    stored = {row['iherb_product_id']: row['fingerprint'] for row in curs.fetchall()}
+    return [prod for prod in products if stored.get(prod.product_id) != prod.fingerprint()]
 
 
 @connect_to_pymysql
-def populate_product_category(curs, prod):
+def preload_id_caches(curs):
     """
-    Inserts a new product-category association record into the database using the given product object and
-    database cursor.
+    Fills the id caches with every brand, category and inventory status already in the DB.
+
+    These tables only hold a few hundred rows, so loading them once at the start of a run saves a lookup for each
+    batch that brings new names.
 
     Args:
-        prod (Product): The product object to associate with a category.
         curs: The database cursor to use for executing SQL queries.
 
     Returns:
         None
-
-    Raises:
-        pymysql.err.Error: If there is an error executing the SQL query.
-    """
-    curs.execute(SELECT_CATEGORY_ID.format(category=prod.category))
-    result = curs.fetchall()
-    category_id = result[0]['id']
-    curs.execute(SELECT_PRODUCT_ID_USING_IHERB_ID.format(product_id=prod.product_id))
-    result = curs.fetchall()
-    product_id = result[0]['id']
-    try:
-        curs.execute(INSERT_PRODUCT_CATEGORY.format(product_id=product_id, category_id=category_id))
-    except pymysql.err.Error as e:
-        logging.info(
-            f"""FAIL : {INSERT_PRODUCT_CATEGORY.format(product_id=product_id, category_id=category_id)}
-                        CAUSE = {e}""")
+    """
+    for cache, query in ((BRAND_IDS, SELECT_ALL_BRAND_IDS), (CATEGORY_IDS, SELECT_ALL_CATEGORY_IDS),
+                         (STATUS_IDS, SELECT_ALL_STATUS_IDS)):
+        curs.execute(query)
+        cache.add(curs.fetchall())
 
 
 @connect_to_pymysql
-def get_brands_names(curs, products):
+def get_brands_names(curs, brand_names):
     """
-    Returns a list of dictionaries representing the brands of the given products.
+    Returns a list of dictionaries representing the brands with the given names.
 
     Args:
-        products (List[Product]): A list of Product objects with brand names.
+        brand_names (Iterable[str]): The names of the brands to look up, e.g. the brand names of the scraped products.
         curs (Cursor): A database cursor used to execute SQL queries.
 
     Returns:
         List[Dict[str, Union[int, str]]]: A list of dictionaries with the keys 'id' and 'name',
-        representing the id and name of each brand. The list is ordered according to the order
-        of the given products.
+        representing the id and name of each brand.
 
     Raises:
         DatabaseError: If there is an error executing the SQL query.
 
     Example:
-        products = [Product(brand_name='Apple'), Product(brand_name='Samsung')]
-        curs = conn.cursor()
-        brands = get_brands_names(products, curs)
+        brands = get_brands_names({'Apple', 'Samsung'})
         # brands == [{'id': 1, 'name': 'Apple'}, {'id': 2, 'name': 'Samsung'}]
 
     """
-    brands_list = list(set([f'"{str(product.brand_name)}"' for product in products]))
-    brands = ",".join(brands_list)
+    brands_list = list({str(brand_name) for brand_name in brand_names})
     try:
-        curs.execute(SELECT_BRANDS_FROM_REQ.format(brands=brands))
+        curs.execute(SELECT_BRANDS_FROM_REQ.format(brands=_placeholders(brands_list)), brands_list)
     except BaseException as error:
         print("ERROR : ", error)
         logging.error(f"Error: {error}")
@@ -284,11 +482,11 @@ def get_brands_names(curs, products):
 @connect_to_pymysql
 def update_number_tweets(curs, brands):
     """
-    Update the number of tweets for each brand in the database.
+    Update the number of tweets and the tweet watermark of each brand in the database, with a single statement.
 
     Args:
-        brands (list): A list of dictionaries, where each dictionary represents a brand and contains the keys 'id'
-            and 'tweets_qty'.
+        brands (list): A list of dictionaries, where each dictionary represents a brand and contains the keys 'id',
+            'number_of_tweets' and optionally 'tweets_since_id', the ID of the newest tweet counted.
         curs: The cursor object used to execute the SQL queries.
 
     Returns:
@@ -298,15 +496,70 @@ def update_number_tweets(curs, brands):
         pymysql.err.Error: If an error occurs while executing the SQL query.
 
     Example usage:
-        brands = [{'id': 1, 'name'='toto', 'tweets_qty': 100}, {'id': 2,'name'='tata', 'tweets_qty': 200}]
-        curs = conn.cursor()
-        update_number_tweets(brands, curs)
+        brands = [{'id': 1, 'name': 'toto', 'number_of_tweets': 100}, {'id': 2, 'name': 'tata', 'number_of_tweets': 200}]
+        update_number_tweets(brands)
     """
-    for brand in brands:
-        id_ = brand['id']
-        tweets_qty = brand['number_of_tweets']
-        try:
-            curs.execute(UPDATE_BRAND_TWEETS_QTY.format(tweets=tweets_qty, brand_id=id_))
-        except pymysql.err.Error as e:
-            logging.info(
-                f"""FAIL : {UPDATE_BRAND_TWEETS_QTY.format(tweets=tweets_qty, brand_id=id_)} CAUSE : {e}""")
+    if not brands:
+        return
+    cases = " ".join([BRAND_TWEETS_QTY_CASE] * len(brands))
+    parameters = [value for brand in brands for value in (brand['id'], brand['number_of_tweets'])]
+    parameters += [value for brand in brands for value in (brand['id'], brand.get('tweets_since_id'))]
+    parameters += [brand['id'] for brand in brands]
+    curs.execute(UPDATE_BRAND_TWEETS_QTY.format(cases=cases, brand_ids=_placeholders(brands)), parameters)
+
+
+class BrandTweetsBuffer:
+    """
+    A write-behind buffer for the number of tweets and the tweet watermark of the brands.
+
+    The counts are kept in memory and written with a single `update_number_tweets` statement once `size` brands are
+    waiting, when a count is added `interval` seconds or more after the last write, and when the buffer is closed.
+    The interval is only checked by `add`: while no count comes in, e.g. during a rate limit pause, the waiting counts
+    stay in the buffer. Each write is committed on its own, so a crash loses at most the counts still in the buffer.
+
+    Example usage:
+        with BrandTweetsBuffer() as buffer:
+            for brand in brands:
+                buffer.add(brand['id'], count_tweets(brand['name']))
+        # the remaining counts are written here
+
+    Attributes
+    ----------
+    size : int
+        The number of brands that triggers a write.
+    interval : float
+        The number of seconds after which the waiting counts are written with the next count added.
+    """
+
+    def __init__(self, size=TWEETS_FLUSH_SIZE, interval=TWEETS_FLUSH_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.nb_flushes = 0
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def add(self, brand_id, number_of_tweets, since_id=None):
+        """
+        Records the number of tweets of a brand and the ID of the newest of them, writing the buffer if it is full or
+        old enough.
+        """
+        self._pending[brand_id] = (number_of_tweets, since_id)
+        if len(self._pending) >= self.size or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every waiting count to the database.
+        """
+        if self._pending:
+            update_number_tweets([{'id': brand_id, 'number_of_tweets': number_of_tweets, 'tweets_since_id': since_id}
+                                  for brand_id, (number_of_tweets, since_id) in self._pending.items()])
+            self._pending = {}
+            self.nb_flushes += 1
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
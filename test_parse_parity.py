@@ -0,0 +1,135 @@
+import os
+import re
+
+import pytest
+from bs4 import BeautifulSoup
+
+import benchmark
+import product
+import requestiherb
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_PAGES = ["results_page_1.html", "results_page_2.html", "results_page_3.html"]
+SOUP_PARSER_TYPES = ["html.parser", "lxml"]
+PARSER_TYPES = SOUP_PARSER_TYPES + [
+    pytest.param("selectolax", marks=pytest.mark.skipif(requestiherb.LexborHTMLParser is None,
+                                                        reason="selectolax is not installed")),
+]
+
+
+def _read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def _pages():
+    pages = [(name, _read_fixture(name)) for name in FIXTURE_PAGES]
+    pages += [(f"benchmark_page_{i}", html) for i, html in enumerate(benchmark.generate_pages(2), 1)]
+    return pages
+
+
+PAGES = _pages()
+# The legacy extractor is kept as it was, with the names of bs4 3
+pytestmark = pytest.mark.filterwarnings("ignore:Call to deprecated method findNext:DeprecationWarning")
+
+
+def legacy_parse_products(html, parser_type):
+    """
+    The extractor replaced by the single pass over each card, as it was: every field but the attributes of the link
+    is searched forward from the card, past its end if the card lacks it.
+    """
+    soup = BeautifulSoup(html, parser_type)
+    products = []
+    for item in soup.find_all('div', class_=r'product-inner product-inner-wide'):
+        url = item.a['href']
+        name = item.findNext('div', attrs={'itemprop': "name", 'class': 'product-title'}).text
+        try:
+            rating = float(item.findNext('meta', {'itemprop': 'ratingValue'})['content'])
+            nb_reviews = int(item.findNext('meta', {'itemprop': 'reviewCount'})['content'])
+        except TypeError:
+            rating = 0
+            nb_reviews = 0
+        product_id = int(item.a['data-product-id'])
+        part_no = item.a['data-part-number']
+        brand_name = item.a['data-ga-brand-name']
+        brand_id = item.a['data-ga-brand-id']
+        discount_price = float(re.sub(r'[^\d.]', '', item.a['data-ga-discount-price']))
+        out_of_stock = item.a['data-ga-is-out-of-stock']
+        has_discount = item.a['data-ga-is-discontinued']
+        inventory_status = item.a['data-ga-inventory-status']
+        currency = item.findNext('meta', attrs={'itemprop': 'priceCurrency'})['content']
+        price = item.findNext('meta', attrs={'itemprop': 'price'})['content']
+        category = item.findNext('div', attrs={'itemprop': 'category'})['content']
+        # The price and the flags are typed since the products store them with their own type
+        products.append(
+            product.Product(url=url, name=name, rating=rating, nb_reviews=nb_reviews, image=None,
+                            product_id=product_id, part_no=part_no, brand_name=brand_name, brand_id=brand_id,
+                            discount_price=discount_price, out_of_stock=requestiherb._as_bool(out_of_stock),
+                            has_discount=requestiherb._as_bool(has_discount), inventory_status=inventory_status,
+                            currency=currency, price=requestiherb._as_price(price), category=category))
+    return products
+
+
+def _fields(prod):
+    return tuple(getattr(prod, field) for field in product.FIELDS)
+
+
+def _has_rating(html):
+    cards = BeautifulSoup(html, "html.parser").find_all('div', class_=requestiherb.PRODUCT_CARD_CLASS)
+    return [card.find('meta', itemprop='ratingValue') is not None for card in cards]
+
+
+@pytest.mark.parametrize("page, html", PAGES, ids=[name for name, _ in PAGES])
+@pytest.mark.parametrize("parser_type", PARSER_TYPES)
+def test_same_products_as_the_legacy_extractor(page, html, parser_type):
+    # selectolax is compared with the legacy extractor on the standard library parser
+    legacy_parser_type = parser_type if parser_type in SOUP_PARSER_TYPES else "html.parser"
+    legacy = legacy_parse_products(html, legacy_parser_type)
+    products = requestiherb.parse_products(html, parser_type)
+    assert len(products) == len(legacy) > 0
+    for prod, legacy_prod, has_rating in zip(products, legacy, _has_rating(html)):
+        if has_rating:
+            assert _fields(prod) == _fields(legacy_prod)
+
+
+@pytest.mark.parametrize("parser_type", SOUP_PARSER_TYPES)
+def test_legacy_extractor_took_the_rating_of_the_next_card(parser_type):
+    legacy = legacy_parse_products(_read_fixture("results_page_1.html"), parser_type)
+    assert (legacy[1].rating, legacy[1].nb_reviews) == (4.6, 8814)
+
+
+@pytest.mark.parametrize("parser_type", PARSER_TYPES)
+def test_card_without_rating_gets_no_rating(parser_type):
+    products = requestiherb.parse_products(_read_fixture("results_page_1.html"), parser_type)
+    assert (products[1].rating, products[1].nb_reviews) == (0.0, 0)
+    assert (products[2].rating, products[2].nb_reviews) == (4.6, 8814)
+    # The other fields of the card are the same as with the legacy extractor
+    legacy = legacy_parse_products(_read_fixture("results_page_1.html"), "html.parser")[1]
+    assert [getattr(products[1], field) for field in product.FIELDS if field not in ("rating", "nb_reviews")] == \
+           [getattr(legacy, field) for field in product.FIELDS if field not in ("rating", "nb_reviews")]
+
+
+@pytest.mark.parametrize("parser_type", PARSER_TYPES)
+def test_last_card_without_rating_gets_no_rating(parser_type):
+    products = requestiherb.parse_products(_read_fixture("results_page_2.html"), parser_type)
+    assert (products[-1].rating, products[-1].nb_reviews) == (0.0, 0)
+
+
+@pytest.mark.parametrize("parser_type", PARSER_TYPES)
+def test_product_fields(parser_type):
+    first = requestiherb.parse_products(_read_fixture("results_page_1.html"), parser_type)[0]
+    assert first.url == "https://www.iherb.com/pr/now-foods-creatine-monohydrate/16381"
+    assert first.name == "Now Foods, Sports, Creatine Monohydrate, 2.2 lbs (1 kg)"
+    assert (first.rating, first.nb_reviews) == (4.8, 21047)
+    assert (first.product_id, first.part_no) == (16381, "NOW-16381")
+    assert (first.brand_name, first.brand_id) == ("Now Foods", "522")
+    assert (first.price, first.discount_price, first.currency) == (26.99, 23.49, "USD")
+    assert (first.out_of_stock, first.has_discount, first.inventory_status) == (False, False, "InStock")
+    assert first.category == "Sports"
+
+
+@pytest.mark.parametrize("parser_type", PARSER_TYPES)
+def test_entities_are_decoded(parser_type):
+    first = requestiherb.parse_products(_read_fixture("results_page_2.html"), parser_type)[0]
+    assert first.name == "Nature's Way, Alive! Max6 Daily, \"Sport\" Multi-Vitamin & Minerals, 90 Tablets"
+    assert first.brand_name == "Nature's Way"
@@ -0,0 +1,97 @@
+import sqlite3
+import time
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS tweet_counts (key TEXT PRIMARY KEY, count INTEGER NOT NULL, " \
+               "counted_at REAL NOT NULL, since_id INTEGER);"
+SELECT_COLUMNS = "PRAGMA table_info(tweet_counts);"
+# The files written before the watermarks were cached lack the column
+ADD_SINCE_ID = "ALTER TABLE tweet_counts ADD COLUMN since_id INTEGER;"
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS tweet_counts_counted_at ON tweet_counts (counted_at);"
+SELECT_COUNT = "SELECT count, since_id FROM tweet_counts WHERE key = ? AND counted_at >= ?;"
+UPSERT_COUNT = "INSERT INTO tweet_counts (key, count, counted_at, since_id) VALUES (?, ?, ?, ?) " \
+               "ON CONFLICT (key) DO UPDATE SET count = excluded.count, counted_at = excluded.counted_at, " \
+               "since_id = excluded.since_id;"
+DELETE_EXPIRED = "DELETE FROM tweet_counts WHERE counted_at < ?;"
+DELETE_OLDEST = "DELETE FROM tweet_counts WHERE key IN " \
+                "(SELECT key FROM tweet_counts ORDER BY counted_at DESC LIMIT -1 OFFSET ?);"
+
+
+class TweetCountCache:
+    """
+    A durable cache of the number of tweets counted for each search, stored in a SQLite file with the ID of the newest
+    tweet counted, so that a count served from the cache comes with the watermark it was counted up to.
+
+    A count is served for `ttl` seconds after it was counted, whichever run counted it. Expired counts are evicted,
+    as well as the oldest counts beyond `max_entries`, when the cache is opened and every `max_entries` writes.
+
+    Attributes
+    ----------
+    path : str
+        The path of the SQLite file.
+    ttl : float
+        The number of seconds a count stays valid. 0 disables the cache.
+    max_entries : int
+        The maximum number of counts kept in the file.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._nb_writes = 0
+        self._connection = None
+
+    def get(self, key):
+        """
+        Returns the count cached for the key and the ID of the newest tweet it counted, or None if there is none or
+        it has expired.
+        """
+        if not self.ttl:
+            return None
+        row = self._get_connection().execute(SELECT_COUNT, (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], row[1]
+
+    def set(self, key, count, since_id=None):
+        """
+        Stores the count of the key, counted now up to the tweet `since_id`.
+        """
+        if not self.ttl:
+            return
+        connection = self._get_connection()
+        with connection:
+            connection.execute(UPSERT_COUNT, (key, count, time.time(), since_id))
+        self._nb_writes += 1
+        if self._nb_writes % self.max_entries == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the expired counts and the oldest counts beyond `max_entries`.
+        """
+        connection = self._get_connection()
+        with connection:
+            connection.execute(DELETE_EXPIRED, (time.time() - self.ttl,))
+            connection.execute(DELETE_OLDEST, (self.max_entries,))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            with self._connection:
+                self._connection.execute(CREATE_TABLE)
+                columns = [row[1] for row in self._connection.execute(SELECT_COLUMNS)]
+                if "since_id" not in columns:
+                    self._connection.execute(ADD_SINCE_ID)
+                self._connection.execute(CREATE_INDEX)
+            self.evict()
+        return self._connection
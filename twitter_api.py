@@ -1,13 +1,23 @@
 import json
+import logging
 import os
+import threading
 import time
 
 import grequests
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 
-# Import all the Global variables from the configuration file
-with open('conf.json', 'r') as f:
-    config = json.load(f)
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import metrics
+import query_planner
+import tweet_cache
+from settings import config
 
 # These settings are taken from Environment variables
 CONSUMER_KEY = os.environ.get('TWITTER_CONSUMER_KEY')
@@ -16,6 +26,107 @@ ACCESS_TOKEN = os.environ.get('TWITTER_ACCESS_TOKEN')
 ACCESS_TOKEN_SECRET = os.environ.get('TWITTER_ACCESS_TOKEN_SECRET')
 API_URL = 'https://api.twitter.com/1.1/search/tweets.json'
 REQUEST_ACCEPTED_CODE = config["TWITTER_REQUEST_PARAMETERS"]["REQUEST_ACCEPTED_CODE"]
+RATE_LIMITED_CODE = 429
+CONCURRENCY = config["TWITTER_REQUEST_PARAMETERS"]["CONCURRENCY"]
+RATE_LIMIT = config["TWITTER_REQUEST_PARAMETERS"]["RATE_LIMIT"]
+RATE_LIMIT_WINDOW = config["TWITTER_REQUEST_PARAMETERS"]["RATE_LIMIT_WINDOW"]
+STREAM_JSON = config["TWITTER_REQUEST_PARAMETERS"]["STREAM_JSON"]
+TIME_SLEEP = config["TIME_SLEEP"]
+# The shortest wait, in seconds, before the rate limit window is taken as reset, after any response and after a 429
+MIN_RESET_DELAY = 1
+MIN_RATE_LIMITED_DELAY = 60
+GEOCODE = f'{config["TWITTER_REQUEST_PARAMETERS"]["LATITUDE"]},' \
+          f'{config["TWITTER_REQUEST_PARAMETERS"]["LONGITUDE"]},' \
+          f'{config["TWITTER_REQUEST_PARAMETERS"]["RADIUS"]}'
+BATCHING_ENABLED = config["TWEET_QUERY_BATCHING"]["ENABLED"]
+MAX_QUERY_LENGTH = config["TWEET_QUERY_BATCHING"]["MAX_QUERY_LENGTH"]
+# The size of the chunks of the response bodies fed to the streaming JSON parser
+STREAM_CHUNK_SIZE = 16 * 1024
+CACHE = tweet_cache.TweetCountCache(config["TWEET_CACHE"]["PATH"], ttl=config["TWEET_CACHE"]["TTL"],
+                                    max_entries=config["TWEET_CACHE"]["MAX_ENTRIES"])
+
+
+class RateLimiter:
+    """
+    A token bucket holding the requests left in the current rate limit window of the search endpoint.
+
+    Every request takes a token before being sent; when the bucket is empty the caller sleeps exactly until the
+    window resets. The bucket is kept in sync with the 'x-rate-limit-remaining' and 'x-rate-limit-reset' headers of
+    the responses, counting the requests still in flight as already spent, so the concurrent requests never exceed
+    the quota.
+
+    Attributes
+    ----------
+    limit : int
+        The number of requests allowed per window.
+    window : int
+        The length of the rate limit window, in seconds.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_LIMIT_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = time.time() + window
+        self.in_flight = 0
+        self.total_sleep = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until the window resets if there is none left.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                if now >= self.reset_at:
+                    self.remaining = self.limit
+                    self.reset_at = now + self.window
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    self.in_flight += 1
+                    return
+                pause = self.reset_at - now + 1
+            logging.info(f"Twitter rate limit reached, pausing for {pause:.0f} seconds")
+            print(f"We reached the maximum number of requests. Pausing for {pause:.0f} seconds...")
+            self.total_sleep += pause
+            metrics.observe("twitter_rate_limit_sleep_seconds", pause)
+            time.sleep(pause)
+
+    def update(self, response):
+        """
+        Gives back the token of a request that completed and syncs the bucket with the rate limit headers.
+
+        A rate limited (429) response empties the bucket until the reset announced by the API, or for TIME_SLEEP
+        seconds when the response does not announce it. The reset announced is never taken as earlier than
+        MIN_RESET_DELAY seconds from now, or MIN_RATE_LIMITED_DELAY after a 429, as the local clock may be ahead of the
+        one of the API.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            headers = response.headers
+            now = time.time()
+            min_delay = MIN_RATE_LIMITED_DELAY if response.status_code == RATE_LIMITED_CODE else MIN_RESET_DELAY
+            if 'x-rate-limit-reset' in headers:
+                self.reset_at = max(int(headers['x-rate-limit-reset']), now + min_delay)
+            elif response.status_code == RATE_LIMITED_CODE:
+                self.reset_at = now + TIME_SLEEP
+            if response.status_code == RATE_LIMITED_CODE:
+                self.remaining = 0
+            elif 'x-rate-limit-remaining' in headers:
+                self.remaining = min(self.remaining, max(0, int(headers['x-rate-limit-remaining']) - self.in_flight))
+
+    def cancel(self):
+        """
+        Gives back the token of a request that failed without a response.
+
+        The request is no longer counted in flight, but its token stays spent, as it may have reached the API.
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+
+RATE_LIMITER = RateLimiter()
 
 
 def get_oauth1_authentication():
@@ -31,77 +142,390 @@ def get_oauth1_authentication():
     return oauth
 
 
-def run_request(query, max_id):
+# One authenticated session shared by every request, so that the connections to the API are kept alive
+SESSION = requests.Session()
+SESSION.auth = get_oauth1_authentication()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY))
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY))
+
+
+def run_request(query, max_id, since_id=None, extended=False):
     """
-    Sends a request to the Twitter API with the specified query and max_id.
+    Sends a request to the Twitter API with the specified query, max_id and since_id.
 
-    This function creates and sends an asynchronous request to the Twitter API
-    using the grequests library. It includes search parameters such as the query,
-    count, result type, and geocode, and it applies the OAuth1 authentication for
-    the API.
+    This function sends a request to the Twitter API with the shared authenticated
+    session. It includes search parameters such as the query, count, result type,
+    and geocode, and it leaves the entities out of the tweets, which are not counted.
+    The body of the response is streamed, to be read with `read_search_page`.
 
     Args:
         query (str): The search query for the Twitter API request.
         max_id (int or None): The maximum tweet ID to fetch in the request. Set to None if not used.
+        since_id (int or None, optional): Only the tweets with a greater ID are fetched. Defaults to None.
+        extended (bool, optional): Whether the full text of the tweets is requested, instead of their first 140
+            characters. Defaults to False.
 
     Returns:
-        response_: The response object from the grequests request.
+        response_: The response object, whose body has not been read yet.
+
+    Raises:
+        requests.RequestException: If the request could not be sent.
     """
     params = {
         "q": query,
         "count": config["TWITTER_REQUEST_PARAMETERS"]["MAX_TWEETS"],
         "result_type": config["TWITTER_REQUEST_PARAMETERS"]["RESULT_TYPE"],
-        "geocode": f'{config["TWITTER_REQUEST_PARAMETERS"]["LATITUDE"]},'
-                   f'{config["TWITTER_REQUEST_PARAMETERS"]["LONGITUDE"]},'
-                   f'{config["TWITTER_REQUEST_PARAMETERS"]["RADIUS"]}'
+        "geocode": GEOCODE,
+        "include_entities": "false"
     }
     if max_id:
         params["max_id"] = max_id
+    if since_id:
+        params["since_id"] = since_id
+    if extended:
+        params["tweet_mode"] = "extended"
 
-    # Create the grequests request
-    request = grequests.get(API_URL, params=params, auth=get_oauth1_authentication())
-
-    # Send the request asynchronously
-    response_ = grequests.map([request])[0]
+    # Send the request, the monkey-patched socket letting the other greenlets run meanwhile
+    with metrics.timer("twitter_request_seconds"):
+        response_ = SESSION.get(API_URL, params=params, stream=True)
+    metrics.increment("twitter_responses", status=response_.status_code)
     return response_
 
 
-def get_number_of_tweets_async(query):
+def get_cache_key(query):
     """
-    Get the number of tweets containing the given query using the Twitter API asynchronously.
+    Returns the key of the count of a query in the tweet count cache: the query together with the search parameters
+    that change which tweets it matches.
+    """
+    return json.dumps({"q": query, "result_type": config["TWITTER_REQUEST_PARAMETERS"]["RESULT_TYPE"],
+                       "geocode": GEOCODE}, sort_keys=True)
+
+
+def _iter_json_events(response):
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        parser.send(chunk)
+        yield from events
+        del events[:]
+    parser.close()
+    yield from events
+
+
+def _stream_search_page(response):
+    nb_statuses = 0
+    newest_id = None
+    next_results = None
+    has_statuses = False
+    try:
+        for prefix, event, value in _iter_json_events(response):
+            if prefix == "statuses" and event == "start_array":
+                has_statuses = True
+            elif prefix == "statuses.item" and event == "start_map":
+                nb_statuses += 1
+            elif prefix == "statuses.item.id":
+                newest_id = value if newest_id is None else max(newest_id, value)
+            elif prefix == "search_metadata.next_results":
+                next_results = value
+    except ijson.JSONError as err:
+        raise ValueError(f"Invalid JSON response: {err}")
+    if not has_statuses:
+        raise ValueError("The response has no statuses")
+    return nb_statuses, newest_id, next_results
+
+
+def _decode_json_page(response):
+    json_response = response.json()
+    if "statuses" not in json_response:
+        raise ValueError("The response has no statuses")
+    metadata = json_response.get("search_metadata")
+    return json_response["statuses"], metadata.get("next_results") if metadata else None
+
+
+def _decode_search_page(response):
+    statuses, next_results = _decode_json_page(response)
+    return len(statuses), max((status["id"] for status in statuses), default=None), next_results
+
+
+def read_search_page(response):
+    """
+    Reads a page of search results: the number of tweets, the ID of the newest one and the link to the next page.
+
+    The whole page is decoded with `response.json()`, unless STREAM_JSON is set and ijson is installed: the body
+    is then parsed as it is downloaded, counting the tweets without building them in memory, which takes less memory
+    but more CPU time.
 
     Args:
-        query (str, optional): The search query for tweets. Defaults to "California Gold Nutrition".
+        response (requests.Response): A streamed response of the search endpoint.
 
     Returns:
-        int: The number of tweets containing the search query.
+        tuple: The number of tweets of the page, the ID of the newest one or None if there is none, and the
+        'next_results' link of the search metadata or None if it is the last page.
 
     Raises:
-        ValueError: If there's an error in the API response.
+        ValueError: If the body is not a valid page of search results.
+    """
+    try:
+        if STREAM_JSON and ijson is not None:
+            return _stream_search_page(response)
+        return _decode_search_page(response)
+    finally:
+        response.close()
+
+
+def _search(query, since_id, rate_limiter, read_page, extended=False):
+    """
+    Requests every page of results of a query, paging backwards from the newest tweet, and reads each of them with
+    `read_page`, which returns the 'next_results' link of the page.
+
+    Every page of results takes a token of the rate limiter first, and a rate limited page is requested again once
+    the window has been reset.
     """
-    tweet_count = 0
     max_id = None
     while True:
-        # Send the request asynchronously
-        response = run_request(query, max_id)
-
-        # Check for errors in the response
+        rate_limiter.acquire()
+        try:
+            response = run_request(query, max_id, since_id, extended)
+        except Exception:
+            rate_limiter.cancel()
+            raise
+        rate_limiter.update(response)
         if response.status_code != REQUEST_ACCEPTED_CODE:
+            response.close()
+            if response.status_code == RATE_LIMITED_CODE:
+                continue
             raise ValueError("Failed to get tweets (HTTP status code {})".format(response.status_code))
 
-        # If no errors, get the response and count the number of tweets containing the query
-        json_response = response.json()
-        tweet_count += len(json_response["statuses"])
-
-        # Check if there are more results
-        metadata = json_response.get("search_metadata")
-        next_results = metadata.get("next_results") if metadata else None
+        # If no errors, read the page and check if there are more results
+        next_results = read_page(response)
         if not next_results:
             break
         max_id = int(next_results.split('max_id=')[1].split('&')[0]) - 1  # Extract the max_id from the next_results par
-        time.sleep(1)  # Add a delay to avoid hitting rate limits
 
-    return tweet_count
+
+def count_tweets(query, since_id=None, rate_limiter=RATE_LIMITER):
+    """
+    Counts the tweets containing the given query, paging backwards from the newest one.
+
+    Args:
+        query (str): The search query for tweets.
+        since_id (int, optional): Only the tweets newer than this tweet ID are counted. Defaults to None, counting
+            every tweet returned by the search.
+        rate_limiter (RateLimiter, optional): The rate limiter shared by the requests. Defaults to RATE_LIMITER.
+
+    Returns:
+        tuple: The number of tweets counted and the ID of the newest one, or None if there is none.
+
+    Raises:
+        ValueError: If there's an error in the API response.
+        requests.RequestException: If a request could not be sent.
+    """
+    tweet_count = 0
+    newest_id = None
+
+    def read_page(response):
+        nonlocal tweet_count, newest_id
+        nb_statuses, page_newest_id, next_results = read_search_page(response)
+        tweet_count += nb_statuses
+        if page_newest_id is not None:
+            newest_id = page_newest_id if newest_id is None else max(newest_id, page_newest_id)
+        return next_results
+
+    _search(query, since_id, rate_limiter, read_page)
+    return tweet_count, newest_id
+
+
+def _status_text(status):
+    # The search also matches the text of the retweeted and quoted tweets
+    texts = [status.get("full_text") or status.get("text") or ""]
+    for key in ("retweeted_status", "quoted_status"):
+        if key in status:
+            texts.append(status[key].get("full_text") or status[key].get("text") or "")
+    return "\n".join(texts)
+
+
+def count_tweets_of_brands(names, watermarks=None, rate_limiter=RATE_LIMITER):
+    """
+    Counts the tweets of several brands with a single OR-query, attributing each tweet to the brands whose name it
+    mentions.
+
+    The query searches the tweets newer than the oldest watermark of the brands, or every tweet if one of them has
+    none, and each brand only counts the tweets newer than its own watermark.
+
+    Args:
+        names (list): The names of the brands, none of them ambiguous (see `query_planner.is_ambiguous`).
+        watermarks (dict, optional): The number of tweets and the ID of the newest tweet counted by the previous run,
+            by name. Defaults to None.
+        rate_limiter (RateLimiter, optional): The rate limiter shared by the requests. Defaults to RATE_LIMITER.
+
+    Returns:
+        dict: The number of tweets of each brand, including the ones of its watermark, and the ID of the newest of
+        them, by name.
+
+    Raises:
+        ValueError: If there's an error in the API response.
+        requests.RequestException: If a request could not be sent.
+    """
+    watermarks = watermarks or {}
+    since_ids = {}
+    for name in names:
+        number_of_tweets, since_id = watermarks.get(name, (None, None))
+        since_ids[name] = since_id if number_of_tweets is not None else None
+    query_since_id = None if None in since_ids.values() else min(since_ids.values())
+    matcher = query_planner.BrandMatcher(names)
+    counts = dict.fromkeys(names, 0)
+    newest_ids = dict(since_ids)
+
+    def read_page(response):
+        try:
+            statuses, next_results = _decode_json_page(response)
+        finally:
+            response.close()
+        for status in statuses:
+            matched = matcher.match(_status_text(status))
+            if not matched:
+                metrics.increment("twitter_unattributed_tweets")
+            for name in matched:
+                if since_ids[name] is None or status["id"] > since_ids[name]:
+                    counts[name] += 1
+                    newest_ids[name] = max(newest_ids[name] or 0, status["id"])
+        return next_results
+
+    _search(query_planner.build_query(names), query_since_id, rate_limiter, read_page, extended=True)
+    metrics.increment("twitter_counts", len(names), mode="batched")
+    return {name: ((watermarks[name][0] if since_ids[name] is not None else 0) + counts[name], newest_ids[name])
+            for name in names}
+
+
+def get_number_of_tweets_async(query, rate_limiter=RATE_LIMITER, cache=CACHE):
+    """
+    Get the number of tweets containing the given query using the Twitter API asynchronously.
+
+    A count still valid in the tweet count cache is returned without any request. Otherwise, the tweets are counted
+    with `count_tweets` and the final count is stored in the cache.
+
+    Args:
+        query (str, optional): The search query for tweets. Defaults to "California Gold Nutrition".
+        rate_limiter (RateLimiter, optional): The rate limiter shared by the requests. Defaults to RATE_LIMITER.
+        cache (TweetCountCache, optional): The tweet count cache. Defaults to CACHE.
+
+    Returns:
+        int: The number of tweets containing the search query.
+
+    Raises:
+        ValueError: If there's an error in the API response.
+    """
+    return update_number_of_tweets(query, rate_limiter=rate_limiter, cache=cache)[0]
+
+
+def update_number_of_tweets(query, number_of_tweets=None, since_id=None, rate_limiter=RATE_LIMITER, cache=CACHE):
+    """
+    Brings the number of tweets of a query up to date from its watermark: the count stored by the previous run and
+    the ID of the newest tweet it counted.
+
+    With a watermark, only the tweets newer than `since_id` are fetched and added to `number_of_tweets`, so a run
+    costs as many requests as there are new tweets instead of all the matching ones. Without a watermark, every
+    tweet is counted. A count still valid in the tweet count cache is returned without any request, with the
+    watermark it was counted up to.
+
+    Args:
+        query (str): The search query for tweets.
+        number_of_tweets (int, optional): The number of tweets counted up to the watermark. Defaults to None.
+        since_id (int, optional): The ID of the newest tweet of the watermark. Defaults to None.
+        rate_limiter (RateLimiter, optional): The rate limiter shared by the requests. Defaults to RATE_LIMITER.
+        cache (TweetCountCache, optional): The tweet count cache. Defaults to CACHE.
+
+    Returns:
+        tuple: The number of tweets containing the search query and the ID of the newest of them, i.e. the new
+        watermark.
+
+    Raises:
+        ValueError: If there's an error in the API response.
+    """
+    cache_key = get_cache_key(query)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    if since_id is not None and number_of_tweets is not None:
+        new_tweets, newest_id = count_tweets(query, since_id, rate_limiter)
+        metrics.increment("twitter_counts", mode="incremental")
+        tweet_count = number_of_tweets + new_tweets
+        newest_id = newest_id or since_id
+    else:
+        tweet_count, newest_id = count_tweets(query, rate_limiter=rate_limiter)
+        metrics.increment("twitter_counts", mode="full")
+
+    cache.set(cache_key, tweet_count, newest_id)
+    return tweet_count, newest_id
+
+
+def _count_tweets(query, number_of_tweets=None, since_id=None, rate_limiter=RATE_LIMITER, cache=CACHE):
+    try:
+        return [(query,) + update_number_of_tweets(query, number_of_tweets, since_id, rate_limiter, cache)]
+    except (ValueError, requests.RequestException) as err:
+        logging.info(f"Could not count the tweets of {query}: {err}")
+        return [(query, None, None)]
+
+
+def _count_group(names, watermarks, rate_limiter=RATE_LIMITER, cache=CACHE):
+    # The counts of the OR-queries only keep the tweets mentioning the exact phrase of the name, unlike the search of
+    # the name on its own, so they are cached under the quoted name
+    results = []
+    to_count = []
+    for name in names:
+        cached = cache.get(get_cache_key(query_planner.phrase(name)))
+        if cached is not None:
+            results.append((name,) + cached)
+        else:
+            to_count.append(name)
+    if not to_count:
+        return results
+    try:
+        counts = count_tweets_of_brands(to_count, watermarks, rate_limiter)
+    except (ValueError, requests.RequestException) as err:
+        logging.info(f"Could not count the tweets of {', '.join(to_count)}: {err}")
+        return results + [(name, None, None) for name in to_count]
+    for name, (number_of_tweets, since_id) in counts.items():
+        cache.set(get_cache_key(query_planner.phrase(name)), number_of_tweets, since_id)
+        results.append((name, number_of_tweets, since_id))
+    return results
+
+
+def iter_number_of_tweets(queries, concurrency=CONCURRENCY, watermarks=None, batching=BATCHING_ENABLED,
+                          rate_limiter=RATE_LIMITER, cache=CACHE):
+    """
+    Counts the tweets of several queries concurrently, within the rate limit of the Twitter API.
+
+    Up to `concurrency` searches are paged through at the same time, all sharing the rate limiter, so the requests
+    are sent as fast as the quota allows and paused only until the rate limit window resets. With batching, the
+    brands are packed into OR-queries by `query_planner.plan_queries`, so that a single search counts the tweets of
+    many brands with few tweets, and only the ambiguous names are searched on their own.
+
+    Args:
+        queries (Iterable[str]): The search queries, e.g. brand names.
+        concurrency (int, optional): The maximum number of searches at the same time. Defaults to CONCURRENCY.
+        watermarks (dict, optional): The number of tweets and the ID of the newest tweet counted by the previous run,
+            by query. The queries without a watermark are counted in full. Defaults to None.
+        batching (bool, optional): Whether the brands are searched with OR-queries. Defaults to BATCHING_ENABLED.
+        rate_limiter (RateLimiter, optional): The rate limiter shared by the requests. Defaults to RATE_LIMITER.
+        cache (TweetCountCache, optional): The tweet count cache. Defaults to CACHE.
+
+    Yields:
+        tuple: The query, its number of tweets and the ID of its newest tweet, or None and None if the API returned
+        an error, in completion order.
+    """
+    watermarks = watermarks or {}
+    if batching:
+        groups, singles = query_planner.plan_queries(queries, MAX_QUERY_LENGTH)
+    else:
+        groups, singles = [], list(queries)
+    searches = [lambda name=name: _count_tweets(name, *watermarks.get(name, (None, None)), rate_limiter, cache)
+                for name in singles]
+    searches += [lambda group=group: _count_group(group, watermarks, rate_limiter, cache) for group in groups]
+    pool = grequests.Pool(concurrency)
+    for results in pool.imap_unordered(lambda search: search(), searches):
+        yield from results
 
 
 if __name__ == "__main__":